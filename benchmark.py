@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+"""Offline benchmark of the RedditImage rendering path
+
+Usage: ./benchmark.py [-h] [--font FONT] [--repeat N] [--output PATH] [--compare PATH]
+
+Synthetic images are rendered for a matrix of resolutions and titles. RedditImage.__init__,
+_split_title, _wrap_title, add_title and encoding are timed separately, every case runs in a fresh
+process and the peak memory of each stage is measured in a forked child. Results are written as
+json, --compare prints the change against a previous result file.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import time
+from io import BytesIO
+
+import PIL
+from PIL import Image
+
+import titletoimagebot
+from titletoimagebot import RedditImage
+
+RESOLUTIONS = {
+    # smaller than RedditImage.min_size, triggers the LANCZOS upscale
+    'tiny': (320, 240),
+    'photo': (1920, 1080),
+    'phone': (4032, 3024),
+    # larger than RedditImage.max_size, decoded at reduced scale
+    'scan': (9000, 6000)
+}
+
+TITLES = {
+    'short': 'My cat at the beach',
+    'long': ('After three years of restoring this old farmhouse with my grandfather, we finally '
+             'finished the porch last weekend and the whole family came over to celebrate the '
+             'end of a very long project that started with a leaking roof and a lot of mold '
+             '[4032 x 3024]'),
+    'boot': ('Roses are red, violets are blue, the boot is too big, and so are you, I wrote '
+             'this rhyme, to pass the time, the boot is too big, that is no crime, the end.'),
+    'custom': ' '.join(['supercalifragilistic', 'word', 'a', 'Title'] * 20)[:512]
+}
+
+STAGES = ('init', 'split_title', 'wrap_title', 'add_title', 'encode_png', 'encode_jpeg')
+
+
+def _synthetic_jpeg(size, seed=0):
+    """Create a reproducible photo-like JPEG
+
+    :param size: the image size
+    :type size: tuple[int, int]
+    :param seed: the random seed
+    :type seed: int
+    :returns: the encoded image
+    :rtype: bytes
+    """
+    rng = random.Random(seed)
+    channels = []
+    for angle in (0, 120, 240):
+        gradient = Image.linear_gradient('L').rotate(angle).resize(size, Image.BILINEAR)
+        noise = Image.frombytes('L', (64, 64), bytes(rng.randrange(256) for _ in range(4096)))
+        noise = noise.resize(size, Image.BICUBIC)
+        channels.append(Image.blend(gradient, noise, 0.3))
+    buffer = BytesIO()
+    Image.merge('RGB', channels).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def _open(data):
+    """Create a RedditImage from encoded image data and decode it"""
+    image = RedditImage(Image.open(BytesIO(data)))
+    # Image.open is lazy, without load the decode would be counted by the next stage
+    image._image.load()
+    return image
+
+
+def _prepare(stage, data, title):
+    """Prepare the measured call of stage, setup is not measured
+
+    :returns: the function to measure
+    :rtype: callable
+    """
+    if stage == 'init':
+        return lambda: _open(data)
+    image = _open(data)
+    if stage == 'split_title':
+        return lambda: image._split_title(title)
+    if stage == 'wrap_title':
+        return lambda: image._wrap_title(title)
+    if stage == 'add_title':
+        return lambda: image.add_title(title, boot=True)
+    image.add_title(title, boot=True)
+    if stage == 'encode_png':
+        return lambda: image._encode('PNG')
+    return lambda: image._encode('JPEG')
+
+
+def _peak_rss(function):
+    """Get the growth of the peak memory while function runs
+
+    function runs in a forked child, the peak of a new process starts at its current memory, so
+    earlier peaks of the setup don't hide the peak of function (ru_maxrss only grows).
+
+    :param function: the function to measure
+    :type function: callable
+    :returns: peak RSS growth in KiB
+    :rtype: int
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        try:
+            os.close(read_fd)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            function()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_fd, str(after - before).encode())
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        result = pipe.read()
+    os.waitpid(pid, 0)
+    return int(result or 0)
+
+
+def _measure(args):
+    """Measure one stage, runs in a fresh worker process
+
+    tracemalloc is not used, it would slow down the timed runs and doesn't see the pixel
+    buffers of Pillow.
+
+    :param args: (font file, resolution, encoded source image, stage, title name, repeat)
+    :type args: tuple
+    :returns: the result entry
+    :rtype: dict
+    """
+    font_file, resolution, data, stage, title_name, repeat = args
+    RedditImage.font_file = font_file
+    title = TITLES[title_name] if title_name else TITLES['short']
+    peak_rss = _peak_rss(_prepare(stage, data, title))
+    times = []
+    for _ in range(repeat):
+        function = _prepare(stage, data, title)
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {
+        'resolution': resolution,
+        'size': RESOLUTIONS[resolution],
+        'stage': stage,
+        'title': title_name,
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'peak_rss_kib': peak_rss
+    }
+
+
+def _cases(font_file, repeat):
+    """Yield the measurement matrix, the source images are created once"""
+    for resolution, size in RESOLUTIONS.items():
+        data = _synthetic_jpeg(size)
+        for stage in STAGES:
+            if stage in ('init', 'encode_png', 'encode_jpeg'):
+                yield font_file, resolution, data, stage, None, repeat
+                continue
+            for title_name in TITLES:
+                yield font_file, resolution, data, stage, title_name, repeat
+
+
+def _compare(results, baseline_path):
+    """Print the change of the median times against a previous result file
+
+    :param results: the current results
+    :type results: dict
+    :param baseline_path: the previous result file
+    :type baseline_path: str
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    def key(entry):
+        return entry['resolution'], entry['stage'], entry['title']
+
+    previous = {key(entry): entry for entry in baseline['results']}
+    print('{:<8} {:<12} {:<8} {:>12} {:>12} {:>8}'.format(
+        'size', 'stage', 'title', 'before [ms]', 'after [ms]', 'change'))
+    for entry in results['results']:
+        old = previous.get(key(entry))
+        if not old:
+            continue
+        change = entry['median'] / old['median'] - 1 if old['median'] else 0
+        print('{:<8} {:<12} {:<8} {:>12.2f} {:>12.2f} {:>+7.0%}'.format(
+            entry['resolution'], entry['stage'], entry['title'] or '-',
+            old['median'] * 1000, entry['median'] * 1000, change))
+
+
+def main():
+    """Main function, see module docstring"""
+    parser = argparse.ArgumentParser(description='Benchmark RedditImage rendering offline')
+    parser.add_argument('--font', default=RedditImage.font_file,
+                        help='font file (default {})'.format(RedditImage.font_file))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='measurements per case (default 5)')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='result file (default benchmark.json)')
+    parser.add_argument('--compare', help='previous result file to compare with')
+    args = parser.parse_args()
+    # a fresh process per case, so peak memory and caches of one case don't affect the next
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        entries = []
+        for entry in pool.imap(_measure, _cases(args.font, args.repeat)):
+            print('{resolution:<8} {stage:<12} {title!s:<8} {median:>8.4f}s '
+                  '{peak_rss_kib:>8} KiB'.format(**entry))
+            entries.append(entry)
+    results = {
+        'version': titletoimagebot.__version__,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'timestamp': time.time(),
+        'repeat': args.repeat,
+        'results': entries
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    if args.compare:
+        _compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,610 @@
+#!/usr/bin/env python3
+
+"""Record-and-replay load test for TitleToImageBot
+
+Usage:
+    ./loadtest.py record [-h] [--limit N] archive subreddit
+    ./loadtest.py synthesize [-h] [--submissions N] [--mentions N] [--seed N] archive
+    ./loadtest.py replay [-h] [--limit N] [--cycles N | --scheduled SECONDS] [--incremental]
+                         [--shards N] [--copies N] [--latency SERVICE=MS]
+                         [--error-rate SERVICE=P] [--ratelimit-rate SERVICE=P]
+                         [--imgur-credits N] [--unpaced] [--font FONT] [--report PATH] archive
+
+record captures the hot listing, the inbox, mentioned submissions and all source images with
+the credentials in apidata.py. synthesize creates an archive with generated images instead.
+replay runs the bot against local stand-ins for reddit, imgur and the image hosts (configurable
+latency, error and ratelimit rates per service) and reports submissions per second and the
+latency from the first listing that contained an item to the reply.
+
+Archive layout: <archive>/archive.jsonl (one record per line) and <archive>/assets/<sha256>.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+SERVICES = ('reddit', 'imgur', 'images')
+BOT_NAME = 'TitleToImageBot'
+
+
+class Archive:
+    """Recorded listings, submissions and image assets
+
+    :param directory: the archive directory
+    :type directory: str
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.listings = {}
+        self.submissions = {}
+        self.assets = {}
+
+    def _asset_path(self, sha256):
+        return os.path.join(self.directory, 'assets', sha256)
+
+    def add_asset(self, url, data, content_type):
+        """Store image data for url
+
+        :param url: the source url
+        :type url: str
+        :param data: the image file content
+        :type data: bytes
+        :param content_type: the content type of the response
+        :type content_type: str
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        os.makedirs(os.path.dirname(self._asset_path(sha256)), exist_ok=True)
+        with open(self._asset_path(sha256), 'wb') as asset_file:
+            asset_file.write(data)
+        self.assets[url] = {'sha256': sha256, 'content_type': content_type}
+
+    def read_asset(self, sha256):
+        """Read image data
+
+        :param sha256: the asset hash
+        :type sha256: str
+        :rtype: bytes
+        """
+        with open(self._asset_path(sha256), 'rb') as asset_file:
+            return asset_file.read()
+
+    def save(self):
+        """Write archive.jsonl"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'archive.jsonl'), 'w') as archive_file:
+            for name, data in self.listings.items():
+                archive_file.write(json.dumps({'type': 'listing', 'name': name,
+                                               'data': data}) + '\n')
+            for submission_id, data in self.submissions.items():
+                archive_file.write(json.dumps({'type': 'submission', 'id': submission_id,
+                                               'data': data}) + '\n')
+            for url, asset in self.assets.items():
+                archive_file.write(json.dumps(dict(asset, type='asset', url=url)) + '\n')
+
+    @classmethod
+    def load(cls, directory):
+        """Read archive.jsonl
+
+        :param directory: the archive directory
+        :type directory: str
+        :rtype: Archive
+        """
+        archive = cls(directory)
+        with open(os.path.join(directory, 'archive.jsonl')) as archive_file:
+            for line in archive_file:
+                record = json.loads(line)
+                if record['type'] == 'listing':
+                    archive.listings[record['name']] = record['data']
+                elif record['type'] == 'submission':
+                    archive.submissions[record['id']] = record['data']
+                elif record['type'] == 'asset':
+                    archive.assets[record['url']] = {'sha256': record['sha256'],
+                                                     'content_type': record['content_type']}
+        return archive
+
+
+def _children(listing):
+    """Get the children of a listing"""
+    return listing['data']['children']
+
+
+def _listing(children, after=None):
+    """Build a listing response"""
+    return {'kind': 'Listing', 'data': {'children': children, 'after': after, 'before': None,
+                                        'dist': len(children)}}
+
+
+def _submission_id(context):
+    """Get the submission id from a comment context (/r/sub/comments/<id>/title/...)"""
+    match = re.search(r'/comments/([a-z0-9_]+)/', context or '')
+    return match.group(1) if match else None
+
+
+def record(args):
+    """Record listings, mentioned submissions and images with the live api"""
+    import praw
+    import apidata
+    reddit = praw.Reddit(**apidata.reddit)
+    archive = Archive(args.archive)
+    params = {'limit': args.limit, 'raw_json': 1}
+    archive.listings['hot'] = reddit.request(method='GET', path='/r/{}/hot'.format(
+        args.subreddit), params=params)
+    archive.listings['inbox'] = reddit.request(method='GET', path='/message/inbox',
+                                               params=params)
+    submissions = [child['data'] for child in _children(archive.listings['hot'])]
+    for child in _children(archive.listings['inbox']):
+        submission_id = _submission_id(child['data'].get('context'))
+        if submission_id and submission_id not in archive.submissions:
+            data = reddit.request(method='GET', path='/comments/{}'.format(submission_id),
+                                  params={'limit': 1, 'raw_json': 1})
+            archive.submissions[submission_id] = data
+            submissions.extend(child['data'] for child in _children(data[0]))
+    for submission in submissions:
+        url = submission.get('url')
+        if not url or url in archive.assets:
+            continue
+        for variant in (url, url + '.jpg'):
+            try:
+                response = requests.get(variant, timeout=30)
+            except requests.RequestException as error:
+                logging.warning('Cannot record %s | %s', variant, error)
+                continue
+            content_type = response.headers.get('Content-Type', '')
+            if response.ok and content_type.startswith('image/'):
+                archive.add_asset(variant, response.content, content_type)
+                break
+    archive.save()
+    logging.info('Recorded %s hot submissions, %s inbox items, %s assets',
+                 len(_children(archive.listings['hot'])),
+                 len(_children(archive.listings['inbox'])), len(archive.assets))
+
+
+def synthesize(args):
+    """Create an archive with generated submissions, mentions and images"""
+    from benchmark import _synthetic_jpeg
+    rng = random.Random(args.seed)
+    archive = Archive(args.archive)
+    hot = []
+    for i in range(args.submissions):
+        size = rng.choice([(320, 240), (1280, 720), (1920, 1080), (4032, 3024)])
+        url = 'https://i.example.com/{}.jpg'.format(i)
+        archive.add_asset(url, _synthetic_jpeg(size, seed=i), 'image/jpeg')
+        hot.append({'kind': 't3', 'data': {
+            'id': 's{}'.format(i), 'name': 't3_s{}'.format(i), 'author': 'user{}'.format(i),
+            'subreddit': 'loadtest', 'score': rng.randrange(10000), 'url': url,
+            'title': 'Synthetic submission {}, with a title; long enough to wrap maybe'.format(i),
+            'permalink': '/r/loadtest/comments/s{}/synthetic/'.format(i),
+            'created_utc': time.time() - i
+        }})
+    archive.listings['hot'] = _listing(hot)
+    inbox = []
+    for i in range(args.mentions):
+        submission = rng.choice(hot)['data']
+        inbox.append({'kind': 't1', 'data': {
+            'id': 'm{}'.format(i), 'name': 't1_m{}'.format(i), 'author': 'fan{}'.format(i),
+            'subject': 'username mention', 'was_comment': True, 'new': True,
+            'body': '/u/{} "Custom title {}"'.format(BOT_NAME, i),
+            'context': '/r/loadtest/comments/{}/synthetic/m{}/?context=3'.format(
+                submission['id'], i),
+            'created_utc': time.time() - i
+        }})
+    archive.listings['inbox'] = _listing(inbox)
+    archive.save()
+    logging.info('Synthesized %s submissions and %s mentions', len(hot), len(inbox))
+
+
+class StandIn:
+    """Local stand-ins for reddit, imgur and the image hosts
+
+    :param archive: the recorded archive
+    :type archive: Archive
+    :param latency: latency in seconds per service
+    :type latency: dict
+    :param error_rate: probability of an error response per service
+    :type error_rate: dict
+    :param ratelimit_rate: probability of a ratelimit response per service
+    :type ratelimit_rate: dict
+    :param imgur_credits: imgur credits until the reported reset
+    :type imgur_credits: int
+    :param copies: serve every hot submission this many times with different ids and titles
+    :type copies: int
+    """
+    def __init__(self, archive, latency, error_rate, ratelimit_rate, imgur_credits, copies):
+        self._archive = archive
+        self._latency = latency
+        self._error_rate = error_rate
+        self._ratelimit_rate = ratelimit_rate
+        self._imgur_credits = imgur_credits
+        self._copies = copies
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        self._servers = {}
+        self.first_served = {}
+        self.replies = {}
+        self.counters = {}
+        self._comments = []
+
+    def start(self):
+        """Start one http server per service"""
+        for service in SERVICES:
+            server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler(service))
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._servers[service] = server
+        self._prepare_listings()
+
+    def stop(self):
+        """Stop all servers"""
+        for server in self._servers.values():
+            server.shutdown()
+
+    def url(self, service):
+        """Get the base url of a service"""
+        return 'http://127.0.0.1:{}'.format(self._servers[service].server_port)
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+
+    def _roll(self, rates, service):
+        with self._lock:
+            return self._rng.random() < rates.get(service, 0)
+
+    def _asset_url(self, url):
+        asset = self._archive.assets.get(url) or self._archive.assets.get(url + '.jpg')
+        if not asset:
+            return url
+        return '{}/asset/{}'.format(self.url('images'), asset['sha256'])
+
+    def _prepare_listings(self):
+        """Point image urls to the image stand-in and multiply hot submissions"""
+        hot = []
+        for copy in range(self._copies):
+            for child in _children(self._archive.listings.get('hot', _listing([]))):
+                data = dict(child['data'], url=self._asset_url(child['data'].get('url')))
+                if copy:
+                    data['id'] = '{}x{}'.format(data['id'], copy)
+                    data['name'] = 't3_' + data['id']
+                    data['title'] = '{} #{}'.format(data['title'], copy)
+                hot.append({'kind': 't3', 'data': data})
+        self._hot = hot
+        self._submissions = {child['data']['id']: child for child in hot}
+        for submission_id, data in self._archive.submissions.items():
+            for child in _children(data[0]):
+                child = {'kind': 't3', 'data': dict(child['data'], url=self._asset_url(
+                    child['data'].get('url')))}
+                self._submissions[submission_id] = child
+        self._inbox = _children(self._archive.listings.get('inbox', _listing([])))
+
+    def _page(self, children, params):
+        """Paginate children with the limit, after and before parameters"""
+        names = [child['data']['name'] for child in children]
+        limit = int(params.get('limit', 25))
+        if 'before' in params:
+            end = names.index(params['before']) if params['before'] in names else 0
+            page = children[max(0, end - limit):end]
+            after = None
+        else:
+            start = names.index(params['after']) + 1 if params.get('after') in names else 0
+            page = children[start:start + limit]
+            after = page[-1]['data']['name'] if start + limit < len(children) and page else None
+        # reply latency is measured from the first time an item was served, in both directions
+        now = time.time()
+        with self._lock:
+            for child in page:
+                self.first_served.setdefault(child['data']['name'], now)
+        return _listing(page, after)
+
+    def _handler(self, service):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type='application/json', headers=None):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, str(value))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                url = urlparse(self.path)
+                params = {key: value[-1] for key, value in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                form = {key: value[-1] for key, value in
+                        parse_qs(self.rfile.read(length).decode()).items()}
+                time.sleep(stand_in._latency.get(service, 0))
+                stand_in._count('{}_requests'.format(service))
+                if stand_in._roll(stand_in._error_rate, service):
+                    stand_in._count('{}_errors'.format(service))
+                    if service == 'imgur':
+                        self._send(400, {'data': {'error': 'injected error'}, 'success': False})
+                    else:
+                        self._send(500, b'injected error', 'text/plain')
+                    return
+                handler = getattr(stand_in, '_{}'.format(service))
+                self._send(*handler(self.command, url.path.rstrip('/'), params, form))
+
+            do_GET = do_POST = _handle
+
+        return Handler
+
+    def _images(self, method, path, params, form):
+        """Image host stand-in"""
+        sha256 = path.rsplit('/', 1)[-1]
+        try:
+            data = self._archive.read_asset(sha256)
+        except OSError:
+            return 404, b'not found', 'text/plain'
+        content_type = next((asset['content_type'] for asset in self._archive.assets.values()
+                             if asset['sha256'] == sha256), 'image/jpeg')
+        return 200, data, content_type
+
+    def _imgur(self, method, path, params, form):
+        """Imgur api stand-in"""
+        with self._lock:
+            if path.endswith('/upload'):
+                self._imgur_credits -= 10
+            credits = self._imgur_credits
+        headers = {
+            'X-RateLimit-UserLimit': 12500,
+            'X-RateLimit-UserRemaining': max(credits, 0),
+            'X-RateLimit-UserReset': int(time.time()) + 3600,
+            'X-RateLimit-ClientLimit': 12500,
+            'X-RateLimit-ClientRemaining': max(credits, 0)
+        }
+        if path.endswith('/credits'):
+            return 200, {'data': {'UserRemaining': credits}, 'success': True}, \
+                'application/json', headers
+        if credits < 0 or self._roll(self._ratelimit_rate, 'imgur'):
+            self._count('imgur_ratelimited')
+            return 429, {'data': {'error': 'rate limited'}, 'success': False}, \
+                'application/json', headers
+        self._count('imgur_uploads')
+        name = form.get('name', 'image')
+        return 200, {'data': {'link': 'https://i.imgur.com/{}.png'.format(name)},
+                     'success': True}, 'application/json', headers
+
+    def _reddit(self, method, path, params, form):
+        """Reddit api stand-in, oauth and www endpoints"""
+        if path == '/api/v1/access_token':
+            return 200, {'access_token': 'loadtest', 'expires_in': 3600, 'scope': '*',
+                         'token_type': 'bearer'}
+        if path == '/api/v1/me':
+            self._count('reddit_me')
+            return 200, {'name': BOT_NAME, 'id': 'bot'}
+        if path.endswith('/hot'):
+            return 200, self._page(self._hot, params)
+        if path == '/message/inbox':
+            return 200, self._page(self._inbox, params)
+        if path.startswith('/comments/'):
+            child = self._submissions.get(path.split('/')[2])
+            if not child:
+                return 404, {'error': 404}
+            return 200, [_listing([child]), _listing([])]
+        if path == '/api/comment':
+            return self._reply(form)
+        if path.startswith('/user/'):
+            with self._lock:
+                comments = list(reversed(self._comments))
+            return 200, self._page(comments, params)
+        if path == '/api/info':
+            self._count('reddit_info')
+            names = set(params.get('id', '').split(','))
+            submissions = [child for child in self._submissions.values()
+                           if child['data']['name'] in names]
+            with self._lock:
+                comments = [c for c in self._comments if c['data']['name'] in names]
+            return 200, _listing(submissions + comments)
+        if path == '/api/read_message':
+            self._count('reddit_read_message')
+        # read_message, del, compose
+        return 200, {}
+
+    def _reply(self, form):
+        """Handle /api/comment"""
+        if self._roll(self._ratelimit_rate, 'reddit'):
+            self._count('reddit_ratelimited')
+            return 200, {'json': {'errors': [
+                ['RATELIMIT', 'you are doing that too much. try again in 1 minutes.',
+                 'ratelimit']]}}
+        parent = form.get('thing_id')
+        now = time.time()
+        with self._lock:
+            comment_id = 'r{}'.format(len(self._comments))
+            comment = {'kind': 't1', 'data': {
+                'id': comment_id, 'name': 't1_' + comment_id, 'parent_id': parent,
+                'author': BOT_NAME, 'body': form.get('text', ''), 'score': 1,
+                'created_utc': now, 'link_id': parent
+            }}
+            self._comments.append(comment)
+            if parent in self.replies:
+                self.counters['reddit_duplicate_replies'] = \
+                    self.counters.get('reddit_duplicate_replies', 0) + 1
+            self.replies.setdefault(parent, now)
+        self._count('reddit_replies')
+        return 200, {'json': {'errors': [], 'data': {'things': [comment]}}}
+
+
+def _percentile(values, percent):
+    """Get the nearest-rank percentile of values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def _parse_rates(values, cast=float):
+    """Parse SERVICE=VALUE arguments"""
+    rates = {}
+    for value in values or []:
+        service, _, rate = value.partition('=')
+        if service not in SERVICES:
+            raise argparse.ArgumentTypeError('unknown service {}'.format(service))
+        rates[service] = cast(rate)
+    return rates
+
+
+def _run_worker(args, workdir, shard):
+    """Run the bot for args.cycles cycles as one shard, the first shard polls the subreddit"""
+    from titletoimagebot import Scheduler, TitleToImageBot
+    bot = TitleToImageBot('+'.join(['loadtest'][shard[0]::shard[1]]),
+                          cache_dir=os.path.join(workdir, 'cache'), incremental=args.incremental,
+                          shard=shard)
+    if args.scheduled:
+        scheduler = Scheduler(bot.tasks(args.limit, args.scheduled / 4))
+        end = time.monotonic() + args.scheduled
+        while time.monotonic() < end:
+            scheduler.run_once()
+        return
+    for cycle in range(args.cycles):
+        bot.run(args.limit)
+        logging.info('Shard %s/%s cycle %s done', shard[0], shard[1], cycle + 1)
+
+
+def replay(args):
+    """Run the bot against the local stand-ins and report throughput and latency"""
+    archive = Archive.load(args.archive)
+    latency = {service: ms / 1000 for service, ms in _parse_rates(args.latency).items()}
+    stand_in = StandIn(archive, latency, _parse_rates(args.error_rate),
+                       _parse_rates(args.ratelimit_rate), args.imgur_credits, args.copies)
+    stand_in.start()
+    sys.modules['apidata'] = types.SimpleNamespace(
+        reddit={
+            'client_id': 'loadtest', 'client_secret': 'loadtest', 'username': BOT_NAME,
+            'password': 'loadtest', 'user_agent': 'titletoimagebot loadtest',
+            'oauth_url': stand_in.url('reddit'), 'reddit_url': stand_in.url('reddit')
+        },
+        imgur={'client_id': 'loadtest', 'client_secret': 'loadtest'}
+    )
+    import imgurpython.client
+    imgurpython.client.API_URL = stand_in.url('imgur') + '/'
+    import titletoimagebot
+    from titletoimagebot import RedditImage, TitleToImageBot
+    if args.font:
+        RedditImage.font_file = os.path.abspath(args.font)
+    if args.unpaced:
+        TitleToImageBot.rate_limits = {service: (1000, 1000, 0)
+                                       for service in TitleToImageBot.rate_limits}
+    # relative paths are relative to the caller, not to the workdir
+    report_path = args.report and os.path.abspath(args.report)
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    os.chdir(workdir)
+    start = time.time()
+    try:
+        if args.shards == 1:
+            _run_worker(args, workdir, (0, 1))
+        else:
+            # forked workers inherit the patched apidata and imgur api url, the stand-ins keep
+            # running in this process
+            context = multiprocessing.get_context('fork')
+            workers = [context.Process(target=_run_worker, args=(args, workdir, (i, args.shards)))
+                       for i in range(args.shards)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+    finally:
+        elapsed = time.time() - start
+        stand_in.stop()
+    latencies = [reply - stand_in.first_served[name]
+                 for name, reply in stand_in.replies.items() if name in stand_in.first_served]
+    report = {
+        'elapsed': elapsed,
+        'replies': len(stand_in.replies),
+        'submissions_per_second': len(stand_in.replies) / elapsed if elapsed else 0,
+        'latency': {
+            'mean': statistics.mean(latencies) if latencies else None,
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99),
+            'max': max(latencies) if latencies else None
+        },
+        'counters': stand_in.counters,
+        # stage metrics are only collected in this process
+        'metrics': titletoimagebot.metrics.summary() if args.shards == 1 else None,
+        'workdir': workdir
+    }
+    print(json.dumps(report, indent=2))
+    if report_path:
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+def main():
+    """Main function, see module docstring"""
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Record-and-replay load test')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    record_parser = commands.add_parser('record', help='record from the live api')
+    record_parser.add_argument('archive', help='archive directory')
+    record_parser.add_argument('subreddit', help='subreddit(s) to record, joined with +')
+    record_parser.add_argument('--limit', type=int, default=100,
+                               help='amount of submissions/messages to record (default 100)')
+    record_parser.set_defaults(function=record)
+    synthesize_parser = commands.add_parser('synthesize', help='create a synthetic archive')
+    synthesize_parser.add_argument('archive', help='archive directory')
+    synthesize_parser.add_argument('--submissions', type=int, default=50,
+                                   help='amount of hot submissions (default 50)')
+    synthesize_parser.add_argument('--mentions', type=int, default=10,
+                                   help='amount of username mentions (default 10)')
+    synthesize_parser.add_argument('--seed', type=int, default=0, help='random seed')
+    synthesize_parser.set_defaults(function=synthesize)
+    replay_parser = commands.add_parser('replay', help='replay against local stand-ins')
+    replay_parser.add_argument('archive', help='archive directory')
+    replay_parser.add_argument('--limit', type=int, default=100,
+                               help='limit passed to TitleToImageBot.run (default 100)')
+    replay_parser.add_argument('--cycles', type=int, default=2,
+                               help='amount of bot cycles (default 2)')
+    replay_parser.add_argument('--scheduled', type=float, metavar='SECONDS',
+                               help='run the task scheduler for this long instead of --cycles')
+    replay_parser.add_argument('--incremental', action='store_true',
+                               help='run the bot in incremental mode (inbox cursor)')
+    replay_parser.add_argument('--shards', type=int, default=1,
+                               help='run n bot processes sharing one database (default 1)')
+    replay_parser.add_argument('--copies', type=int, default=1,
+                               help='serve every hot submission n times (default 1)')
+    replay_parser.add_argument('--latency', action='append', metavar='SERVICE=MS',
+                               help='latency of reddit, imgur or images in milliseconds')
+    replay_parser.add_argument('--error-rate', action='append', metavar='SERVICE=P',
+                               help='probability of error responses')
+    replay_parser.add_argument('--ratelimit-rate', action='append', metavar='SERVICE=P',
+                               help='probability of ratelimit responses (reddit, imgur)')
+    replay_parser.add_argument('--imgur-credits', type=int, default=12500,
+                               help='imgur credits until the reported reset (default 12500)')
+    replay_parser.add_argument('--unpaced', action='store_true',
+                               help='disable the rate limiter pacing of the bot')
+    replay_parser.add_argument('--font', help='font file for RedditImage')
+    replay_parser.add_argument('--report', help='write the report to this json file')
+    replay_parser.set_defaults(function=replay)
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,61 +6,859 @@ __version__ = '0.7.1'
 __author__ = 'gerenook'
 
 import argparse
+import base64
+import cProfile
+import hashlib
 import json
 import logging
+import os
+import queue
 import re
+import signal
+import socket
 import sqlite3
+import struct
 import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 from logging.handlers import TimedRotatingFileHandler
 from math import ceil
-from os import remove
+from urllib.parse import urlparse
 
 import praw
 import requests
+from requests.adapters import HTTPAdapter
 from imgurpython import ImgurClient
 from imgurpython.helpers.error import (ImgurClientError,
                                        ImgurClientRateLimitError)
-from PIL import Image, ImageDraw, ImageFont
-from prawcore.exceptions import RequestException, ResponseException
+from PIL import GifImagePlugin, Image, ImageChops, ImageDraw, ImageFont
+from prawcore.exceptions import RequestException, ResponseException, ServerError
 
-import apidata
+
+# pixel limits are enforced by RedditImage and ImageDownloader instead of PIL's decompression bomb
+# warning, which only triggers at a fixed size and still lets the image be decoded
+Image.MAX_IMAGE_PIXELS = None
+
+
+class ImageTooLargeError(OSError):
+    """Raised if an image exceeds the byte or pixel limit"""
+
+
+class Metrics:
+    """Thread safe stage latency histograms and event counters
+
+    Exported in the Prometheus text format, either over http (serve) or as a file for the node
+    exporter textfile collector (write_textfile).
+    """
+    prefix = 'titletoimagebot'
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._summary = {}
+        self._summary_counters = {}
+
+    def observe(self, stage, seconds):
+        """Record the duration of a stage
+
+        :param stage: the stage name
+        :type stage: str
+        :param seconds: the duration
+        :type seconds: float
+        """
+        with self._lock:
+            histogram = self._histograms.setdefault(stage, [[0] * len(self.buckets), 0, 0])
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            summary = self._summary.setdefault(stage, [0, 0])
+            summary[0] += seconds
+            summary[1] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        """Record the duration of the with block
+
+        :param stage: the stage name
+        :type stage: str
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def increment(self, event, amount=1):
+        """Increment an event counter (e.g. skipped, cache_hit, retry, error)
+
+        :param event: the event name
+        :type event: str
+        :param amount: the increment
+        :type amount: int
+        """
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + amount
+            self._summary_counters[event] = self._summary_counters.get(event, 0) + amount
+
+    def render(self):
+        """Render all metrics in the Prometheus text format
+
+        :rtype: str
+        """
+        name = self.prefix + '_stage_seconds'
+        lines = ['# HELP {} Time spent in each processing stage'.format(name),
+                 '# TYPE {} histogram'.format(name)]
+        with self._lock:
+            for stage, (counts, total, count) in sorted(self._histograms.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                        name, stage, bound, bucket_count))
+                lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(name, stage, count))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, total))
+                lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, count))
+            name = self.prefix + '_events_total'
+            lines.append('# HELP {} Processing events'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for event, count in sorted(self._counters.items()):
+                lines.append('{}{{event="{}"}} {}'.format(name, event, count))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """Write metrics to path atomically
+
+        :param path: the file path
+        :type path: str
+        """
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(temp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve metrics over http in a daemon thread
+
+        :param port: the port to listen on
+        :type port: int
+        :param host: the address to listen on
+        :type host: str
+        :returns: the server
+        :rtype: http.server.ThreadingHTTPServer
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+    def summary(self):
+        """Summarize stages and events since the last summary
+
+        :returns: e.g. 'download 12x 3.20s, upload 10x 8.10s | cache_hit 2'
+        :rtype: str
+        """
+        with self._lock:
+            stages = ', '.join('{} {}x {:.2f}s'.format(stage, count, total)
+                               for stage, (total, count) in sorted(self._summary.items()))
+            events = ', '.join('{} {}'.format(event, count) for event, count
+                               in sorted(self._summary_counters.items()))
+            self._summary = {}
+            self._summary_counters = {}
+        return '{} | {}'.format(stages or 'no stages', events or 'no events')
+
+
+metrics = Metrics()
+
+
+class CycleProfiler:
+    """Profile the next cycle with cProfile once requested, e.g. with SIGUSR1
+
+    Only the main thread is profiled, pipeline workers show up as waiting time.
+
+    :param directory: directory for the .prof files
+    :type directory: str
+    """
+    def __init__(self, directory='.'):
+        self._directory = directory
+        self._requested = False
+
+    def request(self, *_):
+        """Profile the next cycle, can be used as signal handler"""
+        self._requested = True
+
+    @contextmanager
+    def __call__(self):
+        if not self._requested:
+            yield
+            return
+        self._requested = False
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = os.path.join(self._directory, 'cycle-{}.prof'.format(int(time.time())))
+            profiler.dump_stats(path)
+            logging.info('Saved cycle profile to %s', path)
+
+
+class FontMetrics:
+    """Font with memoized glyph advances and kerning
+
+    Text width is the sum of the glyph advances plus the kerning of each character pair, both
+    are measured once per font and cached.
+
+    :param font: the font
+    :type font: PIL.ImageFont.FreeTypeFont
+    """
+    def __init__(self, font):
+        self.font = font
+        ascent, descent = font.getmetrics()
+        self.ascent = ascent
+        self.line_height = ascent + descent
+        self._advances = {}
+        self._kerning = {}
+
+    def _length(self, text):
+        """Measure text with the font (getlength is not available in old Pillow versions)"""
+        if hasattr(self.font, 'getlength'):
+            return self.font.getlength(text)
+        return self.font.getsize(text)[0]
+
+    def advance(self, character):
+        """Get the advance width of character
+
+        :param character: the character
+        :type character: str
+        :rtype: float
+        """
+        advance = self._advances.get(character)
+        if advance is None:
+            advance = self._advances[character] = self._length(character)
+        return advance
+
+    def kerning(self, left, right):
+        """Get the kerning adjustment between two characters
+
+        :param left: the left character
+        :type left: str
+        :param right: the right character
+        :type right: str
+        :rtype: float
+        """
+        pair = left + right
+        kerning = self._kerning.get(pair)
+        if kerning is None:
+            kerning = self._length(pair) - self.advance(left) - self.advance(right)
+            self._kerning[pair] = kerning
+        return kerning
+
+    def text_width(self, text):
+        """Get the width of text
+
+        :param text: the text to measure
+        :type text: str
+        :rtype: float
+        """
+        width = 0
+        previous = None
+        for character in text:
+            width += self.advance(character)
+            if previous is not None:
+                width += self.kerning(previous, character)
+            previous = character
+        return width
+
+
+class FontCoverage:
+    """Index of the fonts of a fallback chain that have a glyph for each codepoint
+
+    The index is built once from the cmap tables of the fonts and cached on disk, keyed by the
+    font paths, sizes and modification times. Every codepoint maps to a bit mask of the fonts that
+    cover it, so picking the font of a character is a single table lookup.
+
+    :param font_files: the font file names in order of preference
+    :type font_files: list[str]
+    :param table: bit mask of the covering fonts for every codepoint
+    :type table: bytearray
+    """
+    # one bit per font in the table
+    max_fonts = 8
+    codepoints = 0x110000
+    # preferred (lowest) font of every mask, masks without a font map to the first font
+    first = [max(0, (mask & -mask).bit_length() - 1) for mask in range(256)]
+
+    def __init__(self, font_files, table):
+        self.font_files = font_files
+        self.table = table
+
+    @staticmethod
+    def _read_cmap(path, index=0):
+        """Read the codepoints with a glyph from the cmap table of a TrueType/OpenType font
+
+        Unicode subtables of format 12 (full unicode) are preferred over format 4 (BMP only).
+
+        :param path: the font file
+        :type path: str
+        :param index: the font in a font collection (.ttc)
+        :type index: int
+        :returns: list of (first, last) codepoint ranges
+        :rtype: list[tuple[int, int]]
+        :raises ValueError: if the font has no supported cmap subtable
+        """
+        with open(path, 'rb') as font_file:
+            data = font_file.read()
+        offset = 0
+        if data[:4] == b'ttcf':
+            offset, = struct.unpack_from('>I', data, 12 + 4 * index)
+        num_tables, = struct.unpack_from('>H', data, offset + 4)
+        tables = {}
+        for i in range(num_tables):
+            tag, _, table_offset, _ = struct.unpack_from('>4sIII', data, offset + 12 + 16 * i)
+            tables[tag] = table_offset
+        if b'cmap' not in tables:
+            raise ValueError('no cmap table')
+        cmap = tables[b'cmap']
+        subtables = {}
+        for i in range(struct.unpack_from('>H', data, cmap + 2)[0]):
+            platform, encoding, subtable_offset = struct.unpack_from('>HHI', data, cmap + 4 + 8 * i)
+            subtable = cmap + subtable_offset
+            subtable_format, = struct.unpack_from('>H', data, subtable)
+            if platform == 0 or (platform == 3 and encoding in (1, 10)):
+                subtables.setdefault(subtable_format, subtable)
+        ranges = []
+        if 12 in subtables:
+            subtable = subtables[12]
+            groups, = struct.unpack_from('>I', data, subtable + 12)
+            for i in range(groups):
+                first, last, _ = struct.unpack_from('>III', data, subtable + 16 + 12 * i)
+                ranges.append((first, last))
+            return ranges
+        if 4 not in subtables:
+            raise ValueError('no unicode cmap subtable of format 4 or 12')
+        subtable = subtables[4]
+        segments = struct.unpack_from('>H', data, subtable + 6)[0] // 2
+        ends = subtable + 14
+        starts = ends + 2 * segments + 2
+        deltas = starts + 2 * segments
+        range_offsets = deltas + 2 * segments
+        for i in range(segments):
+            last, = struct.unpack_from('>H', data, ends + 2 * i)
+            first, = struct.unpack_from('>H', data, starts + 2 * i)
+            range_offset, = struct.unpack_from('>H', data, range_offsets + 2 * i)
+            if first == 0xFFFF:
+                continue
+            if not range_offset:
+                ranges.append((first, last))
+                continue
+            # glyph ids are looked up in glyphIdArray, 0 is the missing glyph
+            address = range_offsets + 2 * i + range_offset
+            for codepoint in range(first, last + 1):
+                if struct.unpack_from('>H', data, address + 2 * (codepoint - first))[0]:
+                    if ranges and ranges[-1][1] == codepoint - 1:
+                        ranges[-1] = (ranges[-1][0], codepoint)
+                    else:
+                        ranges.append((codepoint, codepoint))
+        return ranges
+
+    @classmethod
+    def _build(cls, fonts):
+        """Build the table from the cmaps of fonts
+
+        :param fonts: list of (font file name, path, index in collection) tuples
+        :type fonts: list[tuple[str, str, int]]
+        :rtype: bytearray
+        """
+        table = bytearray(cls.codepoints)
+        for i, (font_file, path, index) in enumerate(fonts):
+            bit = 1 << i
+            try:
+                ranges = cls._read_cmap(path, index)
+            except (OSError, ValueError, struct.error) as error:
+                logging.warning('Could not read the glyph coverage of %s: %s', font_file, error)
+                # without coverage the first font is used for everything, as without fallbacks
+                ranges = [(0, cls.codepoints - 1)] if i == 0 else []
+            for first, last in ranges:
+                for codepoint in range(first, min(last, cls.codepoints - 1) + 1):
+                    table[codepoint] |= bit
+        return table
+
+    @classmethod
+    def load(cls, font_files, cache_file=None):
+        """Load the coverage of font_files from cache_file, build and cache it if it is outdated
+
+        Fallback fonts that are not installed are skipped.
+
+        :param font_files: the font file names in order of preference
+        :type font_files: iterable[str]
+        :param cache_file: the cache file, the index is not cached if None
+        :type cache_file: str, NoneType
+        :rtype: FontCoverage
+        :raises OSError: if the first font can't be loaded
+        """
+        fonts = []
+        for i, font_file in enumerate(font_files):
+            try:
+                # truetype also finds fonts in the system font directories
+                font = ImageFont.truetype(font_file, 16)
+            except OSError:
+                if i == 0:
+                    raise
+                logging.warning('Fallback font %s not found, skipping it', font_file)
+                continue
+            if len(fonts) == cls.max_fonts:
+                logging.warning('Only %s fonts are supported, skipping %s', cls.max_fonts,
+                                font_file)
+                continue
+            fonts.append((font_file, os.path.abspath(font.path), getattr(font, 'index', 0)))
+        key = []
+        for _, path, index in fonts:
+            stat = os.stat(path)
+            key.append([path, index, stat.st_size, stat.st_mtime_ns])
+        font_names = [font_file for font_file, _, _ in fonts]
+        if cache_file:
+            try:
+                with open(cache_file) as json_file:
+                    cached = json.load(json_file)
+                if cached['fonts'] == key:
+                    table = bytearray(cls.codepoints)
+                    for first, last, mask in cached['ranges']:
+                        table[first:last + 1] = bytes((mask,)) * (last - first + 1)
+                    return cls(font_names, table)
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        start = time.perf_counter()
+        table = cls._build(fonts)
+        logging.info('Built glyph coverage of %s in %.2fs', ', '.join(font_names),
+                     time.perf_counter() - start)
+        if cache_file:
+            # runs of codepoints with the same mask, codepoints without a font are left out
+            ranges = [[match.start(), match.end() - 1, table[match.start()]]
+                      for match in re.finditer(rb'([^\x00])\1*', table, re.DOTALL)]
+            temp_file = '{}.{}.{}'.format(cache_file, os.getpid(), threading.get_ident())
+            try:
+                with open(temp_file, 'w') as json_file:
+                    json.dump({'fonts': key, 'ranges': ranges}, json_file)
+                os.replace(temp_file, cache_file)
+            except OSError as error:
+                logging.warning('Could not write glyph coverage cache %s: %s', cache_file, error)
+        return cls(font_names, table)
+
+
+class FontChain:
+    """Fonts of a fallback chain at the same size, text is measured and drawn as font runs
+
+    Has the measuring interface of FontMetrics, so TitleLayout works with both. Lines are as high
+    as lines of the first font, glyphs of fallback fonts are drawn on its baseline.
+
+    :param fonts: the font metrics in order of preference, the first font is the default
+    :type fonts: list[FontMetrics]
+    :param coverage: the coverage index of the fonts
+    :type coverage: FontCoverage
+    """
+    def __init__(self, fonts, coverage):
+        self.fonts = fonts
+        self.font = fonts[0].font
+        self.ascent = fonts[0].ascent
+        self.line_height = fonts[0].line_height
+        self._coverage = coverage
+
+    def runs(self, text):
+        """Split text into runs of characters drawn with the same font
+
+        A character is drawn with the first font if it has a glyph for it, else with the font of
+        the previous character if it has one (keeps e.g. emoji and their variation selectors
+        together), else with the first fallback font that has one. Characters no font has a glyph
+        for stay in the current run.
+
+        :param text: the text to split
+        :type text: str
+        :returns: list of (text, font metrics) tuples
+        :rtype: list[tuple[str, FontMetrics]]
+        """
+        if len(self.fonts) == 1:
+            return [(text, self.fonts[0])]
+        table = self._coverage.table
+        first = self._coverage.first
+        runs = []
+        start = 0
+        current = 0
+        for i, character in enumerate(text):
+            mask = table[ord(character)]
+            if mask & 1:
+                font = 0
+            elif not mask or mask >> current & 1:
+                font = current
+            else:
+                font = first[mask]
+            if font != current:
+                if i > start:
+                    runs.append((text[start:i], self.fonts[current]))
+                start = i
+                current = font
+        runs.append((text[start:], self.fonts[current]))
+        return runs
+
+    def text_width(self, text):
+        """Get the width of text, kerning is applied within font runs
+
+        :param text: the text to measure
+        :type text: str
+        :rtype: float
+        """
+        if len(self.fonts) == 1:
+            return self.fonts[0].text_width(text)
+        return sum(font.text_width(run) for run, font in self.runs(text))
+
+
+class LineBox:
+    """A line of text positioned on the title strip
+
+    :param text: the text of the line
+    :type text: str
+    :param x: left position
+    :type x: int
+    :param y: top position
+    :type y: int
+    :param width: the measured width of text
+    :type width: float
+    """
+    def __init__(self, text, x, y, width):
+        self.text = text
+        self.x = x
+        self.y = y
+        self.width = width
+
+    def __repr__(self):
+        return 'LineBox({!r}, {}, {}, {})'.format(self.text, self.x, self.y, self.width)
+
+
+class TitleLayout:
+    """Line layout engine for titles
+
+    Every word is measured once and line widths are kept as running sums, so wrapping is linear
+    in the length of the title. Word widths are shared by all titles laid out with the same
+    instance.
+
+    :param metrics: the font metrics
+    :type metrics: FontMetrics, FontChain
+    :param width: the width of the image
+    :type width: int
+    :param margin: the margin around and between lines
+    :type margin: int
+    """
+    delimiters = (',', ';', '.')
+
+    def __init__(self, metrics, width, margin):
+        self._metrics = metrics
+        self._max_width = width - margin
+        self.margin = margin
+        self.line_height = metrics.line_height + margin
+        self._space_width = metrics.text_width(' ')
+        self._word_widths = {}
+
+    def _word_width(self, word):
+        """Get the width of word
+
+        :param word: the word to measure
+        :type word: str
+        :rtype: float
+        """
+        width = self._word_widths.get(word)
+        if width is None:
+            width = self._word_widths[word] = self._metrics.text_width(word)
+        return width
+
+    def wrap(self, title):
+        """Wrap title
+
+        :param title: the title to wrap
+        :type title: str
+        :returns: list of (line, width) tuples
+        :rtype: list[tuple[str, float]]
+        """
+        lines = []
+        line_words = []
+        line_width = 0
+        for word in title.split():
+            word_width = self._word_width(word)
+            if line_words:
+                width = line_width + self._space_width + word_width
+                if width > self._max_width:
+                    lines.append((' '.join(line_words), line_width))
+                    line_words = [word]
+                    line_width = word_width
+                else:
+                    line_words.append(word)
+                    line_width = width
+            else:
+                line_words = [word]
+                line_width = word_width
+        if line_words:
+            lines.append((' '.join(line_words), line_width))
+        return lines
+
+    def split(self, title):
+        """Split title on [',', ';', '.'] into multiple lines, wrap title if a line is too long
+
+        The title is split after every occurrence of the first delimiter found in it.
+
+        :param title: the title to split
+        :type title: str
+        :returns: list of (line, width) tuples
+        :rtype: list[tuple[str, float]]
+        """
+        delimiter = next((c for c in title if c in self.delimiters), None)
+        parts = title.split(delimiter) if delimiter else [title]
+        lines = []
+        for i, part in enumerate(parts):
+            # don't draw ' ' on a new line
+            line = part.lstrip(' ')
+            if i < len(parts) - 1:
+                line += delimiter
+            # remove empty lines (if delimiter is last character)
+            if not line:
+                continue
+            width = self._metrics.text_width(line)
+            # if a line is too long, wrap title instead
+            if width > self._max_width:
+                return self.wrap(title)
+            lines.append((line, width))
+        return lines
+
+    def layout(self, title, boot):
+        """Lay out title
+
+        :param title: the title
+        :type title: str
+        :param boot: if True, split title on [',', ';', '.'], else wrap text
+        :type boot: bool
+        :rtype: list[LineBox]
+        """
+        lines = self.split(title) if boot else self.wrap(title)
+        return [LineBox(line, self.margin, i * self.line_height + self.margin, width)
+                for i, (line, width) in enumerate(lines)]
+
+    def layout_many(self, titles, boot):
+        """Lay out multiple titles for the same font and width
+
+        :param titles: the titles
+        :type titles: iterable[str]
+        :param boot: if True, split titles on [',', ';', '.'], else wrap text
+        :type boot: bool
+        :rtype: list[list[LineBox]]
+        """
+        return [self.layout(title, boot) for title in titles]
+
+    def height(self, lines):
+        """Get the height of the title strip for lines
+
+        :param lines: the laid out lines
+        :type lines: list[LineBox]
+        :rtype: int
+        """
+        return self.line_height * len(lines) + self.margin
+
+
+class FontCache:
+    """Process wide cache of loaded fonts and font coverage indexes
+
+    Fonts are grouped into buckets of similar sizes. If there are more than max_buckets
+    buckets, the least recently used bucket is evicted with all its fonts.
+
+    :param max_buckets: maximum amount of size buckets
+    :type max_buckets: int
+    :param bucket_size: range of font sizes per bucket
+    :type bucket_size: int
+    """
+    def __init__(self, max_buckets=16, bucket_size=8):
+        self.max_buckets = max_buckets
+        self.bucket_size = bucket_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._coverages = {}
+        self._coverage_lock = threading.Lock()
+
+    def get(self, font_file, size):
+        """Get font, load it if it is not cached
+
+        :param font_file: the font file name
+        :type font_file: str
+        :param size: the font size
+        :type size: int
+        :rtype: FontMetrics
+        """
+        bucket_key = size // self.bucket_size
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is not None:
+                self._buckets.move_to_end(bucket_key)
+                metrics = bucket.get((font_file, size))
+                if metrics is not None:
+                    return metrics
+        metrics = FontMetrics(ImageFont.truetype(font_file, size))
+        with self._lock:
+            bucket = self._buckets.setdefault(bucket_key, {})
+            self._buckets.move_to_end(bucket_key)
+            metrics = bucket.setdefault((font_file, size), metrics)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return metrics
+
+    def coverage(self, font_files, cache_file=None):
+        """Get the coverage index of a font chain, load or build it if it is not cached
+
+        :param font_files: the font file names in order of preference
+        :type font_files: tuple[str]
+        :param cache_file: the on disk cache of the index
+        :type cache_file: str, NoneType
+        :rtype: FontCoverage
+        """
+        # building takes a moment, other threads wait for it instead of building it again
+        with self._coverage_lock:
+            coverage = self._coverages.get(font_files)
+            if coverage is None:
+                coverage = self._coverages[font_files] = FontCoverage.load(font_files, cache_file)
+        return coverage
+
+    def chain(self, font_files, size, cache_file=None):
+        """Get the installed fonts of a fallback chain
+
+        :param font_files: the font file names in order of preference
+        :type font_files: tuple[str]
+        :param size: the font size
+        :type size: int
+        :param cache_file: the on disk cache of the coverage index
+        :type cache_file: str, NoneType
+        :rtype: FontChain
+        """
+        coverage = self.coverage(font_files, cache_file)
+        return FontChain([self.get(font_file, size) for font_file in coverage.font_files],
+                         coverage)
 
 
 class RedditImage:
     """RedditImage class
 
-    :param image: the image
+    Images larger than max_size are scaled down while decoding (JPEG files are decoded at a
+    reduced scale directly), images with more than max_pixels pixels are rejected before decoding.
+
+    :param image: the image, only the header should be loaded yet
     :type image: PIL.Image.Image
+    :param max_size: maximum width and height of the image, defaults to RedditImage.max_size
+    :type max_size: int, NoneType
+    :raises ImageTooLargeError: if the image has more than max_pixels pixels
     """
     margin = 10
     min_size = 500
-    # TODO find a font for all unicode chars & emojis
-    # font_file = 'seguiemj.ttf'
+    max_size = 4096
+    max_pixels = 100 * 1000 * 1000
     font_file = 'roboto.ttf'
+    # used in order for characters font_file has no glyph for, fonts that are not installed are
+    # skipped
+    fallback_font_files = ('NotoSans-Regular.ttf', 'NotoSansSymbols2-Regular.ttf',
+                           'NotoSansCJK-Regular.ttc', 'NotoEmoji-Regular.ttf')
+    # codepoint coverage of the fonts, rebuilt if a font file changes
+    font_coverage_file = 'font_coverage.json'
     font_scale_factor = 16
+    font_cache = FontCache()
     regex_resolution = re.compile(r'\s?\[[0-9]+\s?[xX*×]\s?[0-9]+\]')
+    # source formats that are kept lossless (screenshots, drawings, text), everything else is
+    # encoded as jpeg, webp on reddit is nearly always a lossy photo
+    lossless_formats = ('PNG', 'GIF', 'BMP', 'TIFF')
+    # imgur converts png files larger than 5 MB to jpeg itself
+    max_bytes = 5 * 1000 * 1000
+    # zlib level 3 is about three times faster than the default 6 for ~10% larger photos
+    png_options = {'compress_level': 3}
+    jpeg_options = {'subsampling': '4:2:0', 'optimize': True}
+    # qualities tried in order until the encoded image fits into max_bytes
+    jpeg_qualities = (90, 85, 75, 65)
+    # if the lowest quality doesn't fit, downscale at most this many times
+    max_downscale_steps = 3
 
-    def __init__(self, image):
+    def __init__(self, image, max_size=None):
+        max_size = max_size or self.max_size
         self._image = image
-        self.upscaled = False
+        self.source_format = image.format
         width, height = image.size
-        # upscale small images
-        if image.size < (self.min_size, self.min_size):
+        if width * height > self.max_pixels:
+            raise ImageTooLargeError('Image has {}x{} pixels, limit is {}'.format(
+                width, height, self.max_pixels))
+        size, self.upscaled = self._scaled_size(image.size, max_size)
+        if size != image.size:
+            if not self.upscaled:
+                # let the decoder do most of the work
+                self._image.draft(self._image.mode, size)
+            self._image = self._image.resize(size, Image.LANCZOS)
+        self._width, self._height = self._image.size
+        self._init_layout()
+
+    @staticmethod
+    def create(image, max_size=None):
+        """Create a RedditImage, or a RedditAnimation for animated gifs
+
+        :param image: the image, only the header should be loaded yet
+        :type image: PIL.Image.Image
+        :param max_size: maximum width and height of the image
+        :type max_size: int, NoneType
+        :rtype: RedditImage
+        :raises ImageTooLargeError: if the image exceeds the limits
+        """
+        if image.format == 'GIF' and getattr(image, 'is_animated', False):
+            return RedditAnimation(image, max_size)
+        return RedditImage(image, max_size)
+
+    def _scaled_size(self, size, max_size):
+        """Get the size of the image after scaling
+
+        Large images are scaled down to max_size, small images are scaled up to min_size.
+
+        :param size: the source size
+        :type size: tuple[int, int]
+        :param max_size: maximum width and height
+        :type max_size: int
+        :returns: the new size and True if the image is upscaled
+        :rtype: tuple[tuple[int, int], bool]
+        """
+        width, height = size
+        if max(width, height) > max_size:
+            factor = max_size / max(width, height)
+            return (max(1, round(width * factor)), max(1, round(height * factor))), False
+        if size < (self.min_size, self.min_size):
             if width < height:
                 factor = self.min_size / width
             else:
                 factor = self.min_size / height
-            self._image = self._image.resize((ceil(width * factor),
-                                              ceil(height * factor)),
-                                             Image.LANCZOS)
-            self.upscaled = True
-        self._width, self._height = self._image.size
-        self._font_title = ImageFont.truetype(
-            self.font_file,
-            self._width // self.font_scale_factor
-        )
+            return (ceil(width * factor), ceil(height * factor)), True
+        return size, False
+
+    def _init_layout(self):
+        """Set up the title fonts and layout for the current width"""
+        self._metrics = self.font_cache.chain((self.font_file,) + self.fallback_font_files,
+                                              self._width // self.font_scale_factor,
+                                              self.font_coverage_file)
+        self._layout = TitleLayout(self._metrics, self._width, self.margin)
 
     def _split_title(self, title):
         """Split title on [',', ';', '.'] into multiple lines
@@ -70,28 +868,7 @@ class RedditImage:
         :returns: split title
         :rtype: list[str]
         """
-        lines = ['']
-        all_delimiters = [',', ';', '.']
-        delimiter = None
-        for character in title:
-            # don't draw ' ' on a new line
-            if character == ' ' and not lines[-1]:
-                continue
-            # add character to current line
-            lines[-1] += character
-            # find delimiter
-            if not delimiter:
-                if character in all_delimiters:
-                    delimiter = character
-            # end of line
-            if character == delimiter:
-                lines.append('')
-        # if a line is too long, wrap title instead
-        for line in lines:
-            if self._font_title.getsize(line)[0] + RedditImage.margin > self._width:
-                return self._wrap_title(title)
-        # remove empty lines (if delimiter is last character)
-        return [line for line in lines if line]
+        return [line for line, _ in self._layout.split(title)]
 
     def _wrap_title(self, title):
         """Wrap title
@@ -101,164 +878,1684 @@ class RedditImage:
         :returns: wrapped title
         :rtype: list
         """
-        lines = ['']
-        line_words = []
-        words = title.split()
-        for word in words:
-            line_words.append(word)
-            lines[-1] = ' '.join(line_words)
-            if self._font_title.getsize(lines[-1])[0] + RedditImage.margin > self._width:
-                lines[-1] = lines[-1][:-len(word)].strip()
-                lines.append(word)
-                line_words = [word]
-        # remove empty lines
-        return [line for line in lines if line]
+        return [line for line, _ in self._layout.wrap(title)]
+
+    def _render_title(self, title, boot, bg_color, text_color):
+        """Render title onto a new strip as wide as the image
+
+        :param title: the title to render
+        :type title: str
+        :param boot: if True, split title on [',', ';', '.'], else wrap text
+        :type boot: bool
+        :param bg_color: the background color
+        :type bg_color: str
+        :param text_color: the text color
+        :type text_color: str
+        :returns: the title strip
+        :rtype: PIL.Image.Image
+        """
+        # remove resolution appended to title (e.g. '<title> [1000 x 1000]')
+        title = RedditImage.regex_resolution.sub('', title)
+        lines = self._layout.layout(title, boot)
+        strip = Image.new('RGB', (self._width, self._layout.height(lines)), bg_color)
+        draw = ImageDraw.Draw(strip)
+        for line in lines:
+            x = line.x
+            for text, font in self._metrics.runs(line.text):
+                draw.text((x, line.y + self._metrics.ascent - font.ascent), text, text_color,
+                          font.font)
+                x += font.text_width(text)
+        return strip
 
     def add_title(self, title, boot, bg_color='#fff', text_color='#000'):
         """Add title to new whitespace on image
 
-        :param title: the title to add
+        :param title: the title to add
+        :type title: str
+        :param boot: if True, split title on [',', ';', '.'], else wrap text
+        :type boot: bool
+        """
+        strip = self._render_title(title, boot, bg_color, text_color)
+        new = Image.new('RGB', (self._width, self._height + strip.height))
+        new.paste(strip, (0, 0))
+        new.paste(self._image, (0, strip.height))
+        self._width, self._height = new.size
+        self._image = new
+
+    def _encode(self, image_format, image=None, **options):
+        """Encode self._image in memory
+
+        Pillow releases the GIL while encoding, encoders can run in parallel threads.
+
+        :param image_format: the PIL format name (e.g. 'PNG')
+        :type image_format: str
+        :param image: the image to encode, defaults to self._image
+        :type image: PIL.Image.Image, NoneType
+        :param options: encoder options, defaults to png_options or jpeg_options
+        :returns: the encoded image
+        :rtype: bytes
+        """
+        if image is None:
+            image = self._image
+        if not options:
+            options = self.png_options if image_format == 'PNG' else self.jpeg_options
+        buffer = BytesIO()
+        with metrics.timer('encode'):
+            image.save(buffer, image_format, **options)
+        return buffer.getvalue()
+
+    def output_formats(self):
+        """Get the output formats to try, in order
+
+        Lossless sources are kept as png, jpeg is the fallback if the png exceeds the byte
+        budget. Photos are always encoded as jpeg.
+
+        :returns: PIL format names
+        :rtype: list[str]
+        """
+        if self.source_format in self.lossless_formats:
+            return ['PNG', 'JPEG']
+        return ['JPEG']
+
+    def _encode_jpeg(self, max_bytes):
+        """Encode as jpeg within max_bytes
+
+        The quality is lowered step by step, if even the lowest quality is too large the image
+        is scaled down by the estimated factor and encoded at the lowest quality again. If the
+        last step is still too large, it is returned anyway.
+
+        :param max_bytes: the byte budget
+        :type max_bytes: int
+        :returns: the encoded image
+        :rtype: bytes
+        """
+        image = self._image
+        qualities = self.jpeg_qualities
+        for step in range(self.max_downscale_steps + 1):
+            for quality in qualities:
+                data = self._encode('JPEG', image, quality=quality, **self.jpeg_options)
+                if len(data) <= max_bytes:
+                    return data
+            if step == self.max_downscale_steps:
+                break
+            # the size of a jpeg is roughly proportional to the amount of pixels, the factor is
+            # estimated from the lowest quality, so the smaller image starts there
+            factor = (max_bytes / len(data)) ** 0.5 * 0.9
+            logging.debug('jpeg exceeds %s bytes, scaling down by %.2f', max_bytes, factor)
+            image = image.resize((max(1, int(image.width * factor)),
+                                  max(1, int(image.height * factor))), Image.LANCZOS)
+            qualities = self.jpeg_qualities[-1:]
+        logging.warning('jpeg has %s bytes after %s downscale steps, budget is %s', len(data),
+                        self.max_downscale_steps, max_bytes)
+        metrics.increment('encode_jpeg_over_budget')
+        return data
+
+    def encode(self, max_bytes=None):
+        """Encode self._image in the output format for the source within the byte budget
+
+        :param max_bytes: the byte budget, defaults to RedditImage.max_bytes
+        :type max_bytes: int, NoneType
+        :returns: the encoded image and the PIL format name
+        :rtype: tuple[bytes, str]
+        """
+        max_bytes = max_bytes or self.max_bytes
+        if 'PNG' in self.output_formats():
+            data = self._encode('PNG')
+            if len(data) <= max_bytes:
+                return data, 'PNG'
+            logging.debug('png has %s bytes, budget is %s, trying jpeg', len(data), max_bytes)
+            metrics.increment('encode_png_over_budget')
+        return self._encode_jpeg(max_bytes), 'JPEG'
+
+    def upload(self, uploader, config, encoded=None):
+        """Upload self._image to imgur
+
+        A png that is rejected by imgur is encoded and uploaded again as jpg.
+
+        :param uploader: the imgur uploader
+        :type uploader: ImgurUploader
+        :param config: imgur image config
+        :type config: dict
+        :param encoded: the result of encode, encoded here if None
+        :type encoded: tuple[bytes, str], NoneType
+        :returns: imgur url if upload successful, else None
+        :rtype: str, NoneType
+        """
+        data, image_format = encoded or self.encode()
+        try:
+            response = uploader.upload_bytes(data, config, anon=False)
+        except ImgurClientError as error:
+            if image_format != 'PNG':
+                logging.error('%s upload failed, returning | %s', image_format.lower(), error)
+                return None
+            logging.warning('png upload failed, trying jpg | %s', error)
+            try:
+                response = uploader.upload_bytes(self._encode_jpeg(self.max_bytes), config,
+                                                 anon=False)
+            except ImgurClientError as error:
+                logging.error('jpg upload failed, returning | %s', error)
+                return None
+        return response['link']
+
+
+class RedditAnimation(RedditImage):
+    """Animated gif with added title
+
+    Frames are decoded, composited below the title strip, quantized and encoded one at a time,
+    only the current and the previous frame are held in memory. All frames share one palette,
+    built from the title strip and a sample of frames, and only the region that changed since
+    the previous frame is written.
+
+    :param image: the animated gif, only the header should be loaded yet
+    :type image: PIL.GifImagePlugin.GifImageFile
+    :param max_size: maximum width and height of the frames, at most RedditAnimation.max_size
+    :type max_size: int, NoneType
+    :raises ImageTooLargeError: if the animation has too many frames or pixels
+    """
+    max_size = 1024
+    max_frames = 500
+    # pixels of all output frames together
+    max_total_pixels = 150 * 1000 * 1000
+    # imgur converts larger gifs to mp4
+    max_bytes = 20 * 1000 * 1000
+    # frames used to build the palette
+    palette_samples = 8
+    # width of the sampled frames, the palette doesn't need all pixels
+    palette_sample_width = 256
+
+    def __init__(self, image, max_size=None):
+        max_size = min(max_size or self.max_size, self.max_size)
+        width, height = image.size
+        # every frame is decoded at the source size
+        if width * height > self.max_pixels:
+            raise ImageTooLargeError('Image has {}x{} pixels, limit is {}'.format(
+                width, height, self.max_pixels))
+        self._image = image
+        self.source_format = image.format
+        self.frames = image.n_frames
+        if self.frames > self.max_frames:
+            raise ImageTooLargeError('Animation has {} frames, limit is {}'.format(
+                self.frames, self.max_frames))
+        size, self.upscaled = self._scaled_size(image.size, max_size)
+        if size[0] * size[1] * self.frames > self.max_total_pixels:
+            raise ImageTooLargeError('Animation has {} frames of {}x{} pixels, limit is {}'.format(
+                self.frames, size[0], size[1], self.max_total_pixels))
+        self._width, self._height = size
+        self._strip = None
+        self._bg_color = '#fff'
+        self._init_layout()
+
+    def add_title(self, title, boot, bg_color='#fff', text_color='#000'):
+        """Render the title strip, it is added to every frame by encode
+
+        :param title: the title to add
+        :type title: str
+        :param boot: if True, split title on [',', ';', '.'], else wrap text
+        :type boot: bool
+        """
+        self._strip = self._render_title(title, boot, bg_color, text_color)
+        self._bg_color = bg_color
+
+    def _frames(self, indices=None):
+        """Decode frames one at a time
+
+        :param indices: the frames to decode in ascending order, defaults to all frames
+        :type indices: iterable, NoneType
+        :returns: generator of (frame, duration in ms)
+        """
+        for index in indices if indices is not None else range(self.frames):
+            self._image.seek(index)
+            source = self._image.convert('RGBA')
+            # flatten transparent pixels onto the background
+            frame = Image.new('RGB', source.size, self._bg_color)
+            frame.paste(source, mask=source)
+            if frame.size != (self._width, self._height):
+                frame = frame.resize((self._width, self._height), Image.LANCZOS)
+            yield frame, self._image.info.get('duration', 0)
+
+    def _compose(self, frame):
+        """Paste frame below the title strip"""
+        strip_height = self._strip.height if self._strip else 0
+        canvas = Image.new('RGB', (self._width, self._height + strip_height))
+        if self._strip:
+            canvas.paste(self._strip, (0, 0))
+        canvas.paste(frame, (0, strip_height))
+        return canvas
+
+    def _palette(self):
+        """Build the shared palette from the title strip and evenly spaced frames
+
+        :returns: palette image for Image.quantize
+        :rtype: PIL.Image.Image
+        """
+        samples = min(self.palette_samples, self.frames)
+        indices = sorted({index * self.frames // samples for index in range(samples)})
+        factor = min(1, self.palette_sample_width / self._width)
+        tiles = []
+        for frame, _ in self._frames(indices):
+            # only the small tile is kept, not the full size frame
+            tile = self._compose(frame)
+            tiles.append(tile.resize((max(1, int(tile.width * factor)),
+                                      max(1, int(tile.height * factor))), Image.BILINEAR))
+        mosaic = Image.new('RGB', (tiles[0].width, sum(tile.height for tile in tiles)))
+        y = 0
+        for tile in tiles:
+            mosaic.paste(tile, (0, y))
+            y += tile.height
+        return mosaic.quantize(colors=256, method=Image.MEDIANCUT)
+
+    def encode(self, max_bytes=None):
+        """Encode the animation as gif, frame by frame
+
+        :param max_bytes: the byte budget, defaults to RedditAnimation.max_bytes
+        :type max_bytes: int, NoneType
+        :returns: the encoded animation and 'GIF'
+        :rtype: tuple[bytes, str]
+        :raises ImageTooLargeError: if the gif exceeds max_bytes
+        """
+        max_bytes = max_bytes or self.max_bytes
+        palette = self._palette()
+        loop = self._image.info.get('loop')
+        buffer = BytesIO()
+        previous = None
+        with metrics.timer('encode'):
+            for index, (frame, duration) in enumerate(self._frames()):
+                canvas = self._compose(frame)
+                # without dithering, unchanged pixels get the same palette index
+                frame = canvas.quantize(palette=palette, dither=Image.NONE)
+                if previous is None:
+                    header, _ = GifImagePlugin.getheader(
+                        frame, info={'loop': loop} if loop is not None else {})
+                    buffer.write(b''.join(header))
+                    box = (0, 0) + canvas.size
+                else:
+                    # only write the region that changed, the title strip is written once
+                    box = ImageChops.difference(previous, canvas).getbbox() or (0, 0, 1, 1)
+                previous = canvas
+                for data in GifImagePlugin.getdata(frame.crop(box), box[:2], duration=duration,
+                                                   disposal=1):
+                    buffer.write(data)
+                if buffer.tell() > max_bytes:
+                    raise ImageTooLargeError('Gif exceeds {} bytes after {} of {} frames'.format(
+                        max_bytes, index + 1, self.frames))
+            # trailer
+            buffer.write(b';')
+        return buffer.getvalue(), 'GIF'
+
+
+class ImgurUploader:
+    """Upload images to imgur from memory, no temporary files are written
+
+    :param client: the imgur api client
+    :type client: imgurpython.client.ImgurClient
+    """
+    def __init__(self, client):
+        self._client = client
+
+    @property
+    def credits(self):
+        """Rate limit credits reported with the last response
+
+        :returns: dict with UserRemaining, UserReset, ClientRemaining and ClientLimit
+        :rtype: dict
+        """
+        return getattr(self._client, 'credits', None) or {}
+
+    def upload_bytes(self, data, config=None, anon=True):
+        """Upload encoded image
+
+        :param data: the encoded image
+        :type data: bytes
+        :param config: imgur image config
+        :type config: dict, NoneType
+        :param anon: if True, upload anonymously
+        :type anon: bool
+        :returns: imgur api response data
+        :rtype: dict
+        :raises ImgurClientError: if the upload failed
+        :raises ImgurClientRateLimitError: if the rate limit is exceeded
+        """
+        config = config or {}
+        payload = {
+            'image': base64.b64encode(data),
+            'type': 'base64'
+        }
+        payload.update({field: config[field] for field in
+                        set(self._client.allowed_image_fields).intersection(config)})
+        with metrics.timer('upload'):
+            return self._client.make_request('POST', 'upload', payload, anon)
+
+
+class DownloadError(OSError):
+    """Raised if an image cannot be downloaded
+
+    transient is True if the download may work later (timeouts, connection and server errors).
+    """
+    transient = False
+
+
+class ImageDownloader:
+    """Download images with pooled keep-alive sessions, one session per host
+
+    Bodies are streamed into memory and rejected as soon as the Content-Length header, the
+    amount of received bytes or the image header exceed the limits.
+
+    :param max_bytes: maximum size of the response body in bytes
+    :type max_bytes: int
+    :param max_pixels: maximum image size (width * height) according to the image header
+    :type max_pixels: int
+    :param timeout: connect and read timeout in seconds
+    :type timeout: tuple[float, float]
+    :param pool_size: maximum amount of kept alive connections per host
+    :type pool_size: int
+    """
+    chunk_size = 64 * 1024
+    # stop looking for the image header after this many bytes, leave it to the decoder
+    header_limit = 1024 * 1024
+    # url variants to try, e.g. imgur page links only work with .jpg appended
+    variants = ('{}', '{}.jpg')
+
+    def __init__(self, max_bytes=20 * 1024 * 1024, max_pixels=RedditImage.max_pixels,
+                 timeout=(5, 30), pool_size=8):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+        self._pool_size = pool_size
+        self._sessions = {}
+        self._preferred_variant = {}
+        self._lock = threading.Lock()
+
+    def _session(self, host):
+        """Get the session for host, create it if necessary
+
+        :param host: the host name
+        :type host: str
+        :rtype: requests.Session
+        """
+        with self._lock:
+            session = self._sessions.get(host)
+            if not session:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def _check_header(self, data):
+        """Check image dimensions in the image header
+
+        :param data: the beginning of the image file
+        :type data: bytes, bytearray
+        :returns: True if the header was found, False if more data is needed
+        :rtype: bool
+        :raises ImageTooLargeError: if the image exceeds max_pixels
+        """
+        try:
+            with Image.open(BytesIO(data)) as image:
+                width, height = image.size
+        except OSError:
+            return False
+        if width * height > self.max_pixels:
+            raise ImageTooLargeError('Image has {}x{} pixels, limit is {}'.format(
+                width, height, self.max_pixels))
+        return True
+
+    def _fetch(self, url):
+        """Download url into memory
+
+        :param url: the url to download
+        :type url: str
+        :returns: the response body
+        :rtype: bytes
+        :raises DownloadError: if the request fails or the body is not an image
+        :raises ImageTooLargeError: if a limit is exceeded
+        """
+        session = self._session(urlparse(url).netloc)
+        body = bytearray()
+        header_checked = False
+        try:
+            with session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                length = response.headers.get('Content-Length')
+                if length and length.isdigit() and int(length) > self.max_bytes:
+                    raise ImageTooLargeError('Content-Length {} exceeds limit {}'.format(
+                        length, self.max_bytes))
+                for chunk in response.iter_content(self.chunk_size):
+                    body += chunk
+                    if len(body) > self.max_bytes:
+                        raise ImageTooLargeError('Body exceeds limit {}'.format(self.max_bytes))
+                    if not header_checked and len(body) <= self.header_limit:
+                        header_checked = self._check_header(body)
+        except requests.RequestException as error:
+            download_error = DownloadError('Request failed | {}'.format(error))
+            status = error.response.status_code if error.response is not None else None
+            download_error.transient = status is None or status >= 500 or status == 429
+            raise download_error
+        data = bytes(body)
+        if not header_checked and not self._check_header(data):
+            raise DownloadError('Cannot identify image file {}'.format(url))
+        return data
+
+    def download(self, url):
+        """Download image from url, try all url variants
+
+        The variant that worked last for the host of url is tried first.
+
+        :param url: the image url
+        :type url: str
+        :returns: the image file content
+        :rtype: bytes
+        :raises DownloadError: if no variant returned an image
+        :raises ImageTooLargeError: if a limit is exceeded
+        """
+        host = urlparse(url).netloc
+        preferred = self._preferred_variant.get(host, self.variants[0])
+        variants = [preferred] + [v for v in self.variants if v != preferred]
+        error = None
+        transient = False
+        for variant in variants:
+            try:
+                data = self._fetch(variant.format(url))
+            except DownloadError as variant_error:
+                logging.debug('Download of variant %s failed | %s', variant, variant_error)
+                error = variant_error
+                transient = transient or variant_error.transient
+                continue
+            self._preferred_variant[host] = variant
+            return data
+        error.transient = transient
+        raise error
+
+
+class ImageCache:
+    """On-disk content addressed cache of source images and rendered outputs
+
+    Source urls map to the sha256 hash of the downloaded image, the image itself is stored once
+    per hash. Rendered outputs are keyed by (content hash, title, boot, colors) and map to the
+    imgur url of the uploaded image. Files are evicted least recently used first as soon as the
+    cache grows larger than max_bytes.
+
+    :param directory: the cache directory
+    :type directory: str
+    :param max_bytes: maximum total size of all cached files
+    :type max_bytes: int
+    """
+    def __init__(self, directory='cache', max_bytes=1024 * 1024 * 1024):
+        self._directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = sum(os.path.getsize(path) for path in self._files())
+
+    def _files(self):
+        """Yield paths of all cached files"""
+        for root, _, files in os.walk(self._directory):
+            for filename in files:
+                yield os.path.join(root, filename)
+
+    def _path(self, kind, key):
+        """Get the path of a cache entry
+
+        :param kind: the entry kind (urls, sources or renders)
+        :type kind: str
+        :param key: the hex digest key
+        :type key: str
+        :rtype: str
+        """
+        return os.path.join(self._directory, kind, key[:2], key)
+
+    def _read(self, path):
+        """Read a cache file and mark it as recently used
+
+        :param path: the file path
+        :type path: str
+        :returns: file content, None if not cached
+        :rtype: bytes, NoneType
+        """
+        try:
+            with open(path, 'rb') as cache_file:
+                data = cache_file.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def _write(self, path, data):
+        """Write a cache file atomically, evict old files if the cache is full
+
+        :param path: the file path
+        :type path: str
+        :param data: the file content
+        :type data: bytes
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove least recently used files until the cache is below 90% of max_bytes"""
+        files = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        self._size = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+        logging.debug('Evicted cache files, cache size is now %s bytes', self._size)
+
+    @staticmethod
+    def _digest(data):
+        """Get the hex digest used as cache key for data"""
+        return hashlib.sha256(data).hexdigest()
+
+    def source_hash(self, url):
+        """Get the content hash of the cached source image for url
+
+        The source image itself is not read, see get_source.
+
+        :param url: the source url
+        :type url: str
+        :returns: the content hash, None if not cached
+        :rtype: str, NoneType
+        """
+        content_hash = self._read(self._path('urls', self._digest(url.encode())))
+        return content_hash.decode() if content_hash is not None else None
+
+    def get_source(self, content_hash):
+        """Get cached source image
+
+        :param content_hash: the content hash returned by source_hash
+        :type content_hash: str
+        :returns: image file content, None if not cached
+        :rtype: bytes, NoneType
+        """
+        return self._read(self._path('sources', content_hash))
+
+    def put_source(self, url, data):
+        """Cache source image
+
+        :param url: the source url
+        :type url: str
+        :param data: the image file content
+        :type data: bytes
+        :returns: the content hash
+        :rtype: str
+        """
+        content_hash = self._digest(data)
+        path = self._path('sources', content_hash)
+        if not os.path.exists(path):
+            self._write(path, data)
+        self._write(self._path('urls', self._digest(url.encode())), content_hash.encode())
+        return content_hash
+
+    def render_key(self, content_hash, title, boot, bg_color, text_color):
+        """Get the cache key of a rendered output
+
+        :param content_hash: the content hash of the source image
+        :type content_hash: str
+        :param title: the added title
+        :type title: str
+        :param boot: the boot flag passed to RedditImage.add_title
+        :type boot: bool
+        :param bg_color: the background color
+        :type bg_color: str
+        :param text_color: the text color
+        :type text_color: str
+        :rtype: str
+        """
+        key = json.dumps([content_hash, title, boot, bg_color, text_color])
+        return self._digest(key.encode())
+
+    def get_render(self, key):
+        """Get cached render result
+
+        :param key: the render key
+        :type key: str
+        :returns: dict with imgur_url and upscaled, None if not cached
+        :rtype: dict, NoneType
+        """
+        data = self._read(self._path('renders', key))
+        if data is None:
+            return None
+        return json.loads(data.decode())
+
+    def put_render(self, key, imgur_url, upscaled):
+        """Cache render result
+
+        :param key: the render key
+        :type key: str
+        :param imgur_url: the imgur url of the uploaded output
+        :type imgur_url: str
+        :param upscaled: True if the source image was upscaled
+        :type upscaled: bool
+        """
+        record = {'imgur_url': imgur_url, 'upscaled': upscaled}
+        self._write(self._path('renders', key), json.dumps(record).encode())
+
+
+class Database:
+    """Database class
+
+    Writes are committed immediately, unless they are grouped with transaction().
+
+    Several worker processes on the same host can share one database, jobs and messages are
+    claimed with leases that expire, so the work of a crashed worker is picked up by the others.
+    The database is in WAL mode, which needs shared memory and doesn't work on network
+    filesystems.
+
+    :param db_filename: database filename
+    :type db_filename: str
+    :param owner: unique name of the worker, used for leases
+    :type owner: str
+    :param lease_time: seconds until a lease expires
+    :type lease_time: float
+    :param timeout: seconds to wait for the write lock held by another worker
+    :type timeout: float
+    """
+    # sqlite limits the amount of parameters per query
+    bulk_size = 500
+    # a job fails permanently after this many attempts, including attempts that ended with
+    # the crash of their worker
+    max_attempts = 5
+
+    def __init__(self, db_filename, owner='main', lease_time=600, timeout=30):
+        self._sql_conn = sqlite3.connect(db_filename, timeout=timeout)
+        self._sql = self._sql_conn.cursor()
+        self._sql.execute('PRAGMA journal_mode=WAL')
+        self._sql.execute('PRAGMA synchronous=NORMAL')
+        self.owner = owner
+        self.lease_time = lease_time
+        self._transaction_depth = 0
+        self._known_messages = set()
+        self._submissions = {}
+        self._create_schema()
+
+    def _create_schema(self):
+        """Create tables and indexes if they don't exist"""
+        self._sql.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                author TEXT,
+                subject TEXT,
+                body TEXT
+            );
+            CREATE TABLE IF NOT EXISTS submissions (
+                id TEXT PRIMARY KEY,
+                author TEXT,
+                title TEXT,
+                url TEXT,
+                imgur_url TEXT,
+                retry INTEGER NOT NULL DEFAULT 0,
+                timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS submissions_retry ON submissions (retry);
+            CREATE INDEX IF NOT EXISTS submissions_timestamp ON submissions (timestamp);
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL UNIQUE,
+                submission_id TEXT NOT NULL,
+                comment_id TEXT,
+                payload TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_run REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created REAL NOT NULL,
+                owner TEXT,
+                lease_expires REAL NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, priority, next_run);
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS comments (
+                id TEXT PRIMARY KEY,
+                created REAL NOT NULL,
+                checks INTEGER NOT NULL DEFAULT 0,
+                next_check REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS comments_next_check ON comments (next_check);
+        """)
+        # add lease columns to job tables created before sharding
+        self._sql.execute('PRAGMA table_info(jobs)')
+        columns = {row[1] for row in self._sql.fetchall()}
+        if 'owner' not in columns:
+            self._sql.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+        if 'lease_expires' not in columns:
+            self._sql.execute('ALTER TABLE jobs ADD COLUMN lease_expires REAL NOT NULL DEFAULT 0')
+        self._sql_conn.commit()
+
+    def _commit(self):
+        """Commit, unless a transaction is active"""
+        if not self._transaction_depth:
+            self._sql_conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Group all writes inside the with block into one commit
+
+        Transactions can be nested, only the outermost one commits. On exception, all writes of
+        the transaction are rolled back.
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self._sql_conn.rollback()
+                self._known_messages.clear()
+                self._submissions.clear()
+            raise
+        self._transaction_depth -= 1
+        self._commit()
+
+    def state_get(self, key):
+        """Get a value from the state table (e.g. listing cursors)
+
+        :param key: the state key
+        :type key: str
+        :returns: the value, None if key is not set
+        :rtype: str, NoneType
+        """
+        self._sql.execute('SELECT value FROM state WHERE key=?', (key,))
+        result = self._sql.fetchone()
+        return result[0] if result else None
+
+    def state_set(self, key, value):
+        """Set a value in the state table
+
+        :param key: the state key
+        :type key: str
+        :param value: the value
+        :type value: str
+        """
+        self._sql.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+        self._commit()
+
+    def _execute_chunked(self, query, ids):
+        """Run query for all ids, in chunks of bulk_size
+
+        :param query: the query, {} is replaced with the parameter placeholders
+        :type query: str
+        :param ids: the ids
+        :type ids: list[str]
+        :returns: all result rows
+        :rtype: list[tuple]
+        """
+        rows = []
+        for i in range(0, len(ids), self.bulk_size):
+            chunk = ids[i:i + self.bulk_size]
+            self._sql.execute(query.format(','.join('?' * len(chunk))), chunk)
+            rows.extend(self._sql.fetchall())
+        return rows
+
+    def message_exists(self, message_id):
+        """Check if message exists in messages table
+
+        :param message_id: the message id to check
+        :type message_id: str
+        :returns: True if message was found, else False
+        :rtype: bool
+        """
+        if message_id in self._known_messages:
+            return True
+        self._sql.execute('SELECT EXISTS(SELECT 1 FROM messages WHERE id=? LIMIT 1)', (message_id,))
+        if self._sql.fetchone()[0]:
+            return True
+        return False
+
+    def messages_existing(self, message_ids):
+        """Check which messages exist in messages table with one query
+
+        Following message_exists calls for these ids are answered without a query.
+
+        :param message_ids: the message ids to check, e.g. a page of the inbox
+        :type message_ids: list[str]
+        :returns: the ids that were found
+        :rtype: set[str]
+        """
+        rows = self._execute_chunked('SELECT id FROM messages WHERE id IN ({})', list(message_ids))
+        existing = {row[0] for row in rows}
+        self._known_messages = set(existing)
+        return existing
+
+    def message_insert(self, message_id, author, subject, body):
+        """Insert message into messages table"""
+        self._sql.execute('INSERT OR IGNORE INTO messages (id, author, subject, body) '
+                          'VALUES (?, ?, ?, ?)',
+                          (message_id, author, subject, body))
+        self._known_messages.add(message_id)
+        self._commit()
+
+    @staticmethod
+    def _submission_dict(result):
+        """Convert a submissions row to a dict"""
+        return {
+            'id': result[0],
+            'author': result[1],
+            'title': result[2],
+            'url': result[3],
+            'imgur_url': result[4],
+            'retry': result[5],
+            'timestamp': result[6]
+        }
+
+    def submission_select(self, submission_id):
+        """Select all attributes of submission
+
+        :param submission_id: the submission id
+        :type submission_id: str
+        :returns: query result, None if id not found
+        :rtype: dict, NoneType
+        """
+        if submission_id in self._submissions:
+            return self._submissions.pop(submission_id)
+        self._sql.execute('SELECT * FROM submissions WHERE id=?', (submission_id,))
+        result = self._sql.fetchone()
+        if not result:
+            return None
+        return self._submission_dict(result)
+
+    def submissions_select_many(self, submission_ids):
+        """Select all attributes of multiple submissions with one query
+
+        The next submission_select call for each of these ids is answered without a query.
+
+        :param submission_ids: the submission ids, e.g. a page of a listing
+        :type submission_ids: list[str]
+        :returns: query results by id, ids that were not found are missing
+        :rtype: dict
+        """
+        submission_ids = list(submission_ids)
+        rows = self._execute_chunked('SELECT * FROM submissions WHERE id IN ({})', submission_ids)
+        results = {row[0]: self._submission_dict(row) for row in rows}
+        self._submissions.clear()
+        for submission_id in submission_ids:
+            self._submissions[submission_id] = results.get(submission_id)
+        return results
+
+    def submission_insert(self, submission_id, author, title, url):
+        """Insert submission into submissions table"""
+        self._submissions.pop(submission_id, None)
+        # another worker can insert the same submission, e.g. for a mention
+        self._sql.execute('INSERT OR IGNORE INTO submissions (id, author, title, url) '
+                          'VALUES (?, ?, ?, ?)',
+                          (submission_id, author, title, url))
+        self._commit()
+
+    def submission_set_imgur_url(self, submission_id, imgur_url):
+        """Set imgur url for given submission
+
+        :param submission_id: the submission id to set imgur url
+        :type submission_id: str
+        :param imgur_url: the imgur url to update
+        :type imgur_url: str
+        """
+        self._submissions.pop(submission_id, None)
+        self._sql.execute('UPDATE submissions SET imgur_url=? WHERE id=?',
+                          (imgur_url, submission_id))
+        self._commit()
+
+    def job_enqueue(self, key, submission_id, comment_id, payload, priority=0):
+        """Add job to the jobs table, unless a job with the same key exists
+
+        :param key: unique job key (e.g. the id of the mention)
+        :type key: str
+        :param submission_id: the submission id
+        :type submission_id: str
+        :param comment_id: the id of the comment to reply to, None for top level replies
+        :type comment_id: str, NoneType
+        :param payload: json encoded job data
+        :type payload: str
+        :param priority: jobs with higher priority run first
+        :type priority: int
+        :returns: True if the job was added
+        :rtype: bool
+        """
+        self._sql.execute('INSERT OR IGNORE INTO jobs '
+                          '(key, submission_id, comment_id, payload, priority, created) '
+                          'VALUES (?, ?, ?, ?, ?, ?)',
+                          (key, submission_id, comment_id, payload, priority, time.time()))
+        self._commit()
+        return self._sql.rowcount == 1
+
+    def jobs_claim(self, limit):
+        """Lease due jobs to this worker and return them, highest priority first
+
+        Due jobs are pending jobs and running jobs whose lease expired, e.g. because their
+        worker crashed. Taking over an expired job counts as an attempt, jobs that used up
+        max_attempts fail instead of being claimed again (e.g. images that crash the decoder).
+
+        :param limit: maximum amount of jobs
+        :type limit: int
+        :returns: the claimed jobs
+        :rtype: list[dict]
+        """
+        now = time.time()
+        expires = now + self.lease_time
+        self._sql.execute('UPDATE jobs SET attempts=attempts+(state=\'running\'), '
+                          'state=\'failed\', last_error=\'worker lost the job\' '
+                          'WHERE (state=\'pending\' AND attempts>=?) '
+                          'OR (state=\'running\' AND lease_expires<? AND attempts+1>=?)',
+                          (self.max_attempts, now, self.max_attempts))
+        # a single statement, concurrent workers can't claim the same job
+        self._sql.execute('UPDATE jobs SET attempts=attempts+(state=\'running\'), '
+                          'state=\'running\', owner=?, lease_expires=? WHERE id IN ('
+                          'SELECT id FROM jobs WHERE (state=\'pending\' AND next_run<=?) '
+                          'OR (state=\'running\' AND lease_expires<?) '
+                          'ORDER BY priority DESC, next_run, id LIMIT ?)',
+                          (self.owner, expires, now, now, limit))
+        self._sql.execute('SELECT id, submission_id, comment_id, payload, attempts FROM jobs '
+                          'WHERE state=\'running\' AND owner=? AND lease_expires=? '
+                          'ORDER BY priority DESC, next_run, id', (self.owner, expires))
+        jobs = [{
+            'id': row[0],
+            'submission_id': row[1],
+            'comment_id': row[2],
+            'payload': row[3],
+            'attempts': row[4]
+        } for row in self._sql.fetchall()]
+        self._commit()
+        return jobs
+
+    def job_renew(self, job_id):
+        """Extend the lease of a running job
+
+        :param job_id: the job id
+        :type job_id: int
+        :returns: False if the lease expired and the job was claimed by another worker
+        :rtype: bool
+        """
+        self._sql.execute('UPDATE jobs SET lease_expires=? '
+                          'WHERE id=? AND owner=? AND state=\'running\'',
+                          (time.time() + self.lease_time, job_id, self.owner))
+        self._commit()
+        return self._sql.rowcount == 1
+
+    def job_done(self, job_id, state='done', error=None):
+        """Finish a job leased to this worker
+
+        :param job_id: the job id
+        :type job_id: int
+        :param state: the final state, 'done' or 'failed'
+        :type state: str
+        :param error: the reason the job failed
+        :type error: str, NoneType
+        :returns: False if the lease expired and the job was claimed by another worker
+        :rtype: bool
+        """
+        self._sql.execute('UPDATE jobs SET state=?, last_error=? '
+                          'WHERE id=? AND owner=? AND state=\'running\'',
+                          (state, error, job_id, self.owner))
+        self._commit()
+        return self._sql.rowcount == 1
+
+    def job_retry(self, job_id, error, delay=60):
+        """Schedule a job leased to this worker for another attempt with exponential backoff
+
+        The job fails permanently after Database.max_attempts attempts.
+
+        :param job_id: the job id
+        :type job_id: int
+        :param error: the reason of the retry
+        :type error: str
+        :param delay: delay before the first retry in seconds, doubled for every attempt
+        :type delay: float
+        :returns: True if the job will be retried, False if it failed or the lease expired
+        :rtype: bool
+        """
+        self._sql.execute('SELECT attempts FROM jobs WHERE id=? AND owner=? AND state=\'running\'',
+                          (job_id, self.owner))
+        row = self._sql.fetchone()
+        if row is None:
+            return False
+        attempts = row[0] + 1
+        if attempts >= self.max_attempts:
+            self._sql.execute('UPDATE jobs SET state=\'failed\', attempts=?, last_error=? '
+                              'WHERE id=? AND owner=?', (attempts, error, job_id, self.owner))
+            self._commit()
+            return False
+        self._sql.execute('UPDATE jobs SET state=\'pending\', attempts=?, last_error=?, '
+                          'next_run=? WHERE id=? AND owner=?',
+                          (attempts, error, time.time() + delay * 2 ** (attempts - 1), job_id,
+                           self.owner))
+        self._commit()
+        return True
+
+    def job_postpone(self, job_id, delay):
+        """Set a job leased to this worker back to pending without counting an attempt
+
+        :param job_id: the job id
+        :type job_id: int
+        :param delay: delay in seconds
+        :type delay: float
+        """
+        self._sql.execute('UPDATE jobs SET state=\'pending\', next_run=? '
+                          'WHERE id=? AND owner=? AND state=\'running\'',
+                          (time.time() + delay, job_id, self.owner))
+        self._commit()
+
+    def jobs_release(self):
+        """Set jobs leased to this worker back to pending, e.g. after a restart
+
+        Jobs of other crashed workers are claimed again once their lease expires. Releasing a
+        job counts as an attempt, it may have crashed the worker.
+
+        :returns: amount of released jobs
+        :rtype: int
+        """
+        self._sql.execute('UPDATE jobs SET state=\'pending\', lease_expires=0, '
+                          'attempts=attempts+1 '
+                          'WHERE state=\'running\' AND owner=?', (self.owner,))
+        self._commit()
+        return self._sql.rowcount
+
+    def jobs_prune(self, created_before):
+        """Delete finished jobs created before a time
+
+        Submissions and messages stay in their tables, so pruned jobs are not queued again.
+
+        :param created_before: the cutoff time
+        :type created_before: float
+        :returns: amount of deleted jobs
+        :rtype: int
+        """
+        self._sql.execute('DELETE FROM jobs WHERE state IN (\'done\', \'failed\') AND created<?',
+                          (created_before,))
+        self._commit()
+        return self._sql.rowcount
+
+    def leases_acquire(self, keys):
+        """Lease keys (e.g. message ids) to this worker
+
+        A key can be leased if it is not leased, the lease expired or this worker holds it.
+
+        :param keys: the keys to lease
+        :type keys: list[str]
+        :returns: the leased keys
+        :rtype: set[str]
+        """
+        now = time.time()
+        acquired = set()
+        for key in keys:
+            self._sql.execute('INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?) '
+                              'ON CONFLICT (key) DO UPDATE SET '
+                              'owner=excluded.owner, expires=excluded.expires '
+                              'WHERE leases.owner=excluded.owner OR leases.expires<?',
+                              (key, self.owner, now + self.lease_time, now))
+            if self._sql.rowcount == 1:
+                acquired.add(key)
+        self._commit()
+        return acquired
+
+    def leases_expire(self):
+        """Delete expired leases
+
+        :returns: amount of deleted leases
+        :rtype: int
+        """
+        self._sql.execute('DELETE FROM leases WHERE expires<?', (time.time(),))
+        self._commit()
+        return self._sql.rowcount
+
+    def comment_insert(self, comment_id, created, next_check):
+        """Add a comment of the bot to the comments table
+
+        :param comment_id: the comment id
+        :type comment_id: str
+        :param created: the creation time of the comment
+        :type created: float
+        :param next_check: time of the first score check
+        :type next_check: float
+        """
+        self._sql.execute('INSERT OR IGNORE INTO comments (id, created, next_check) '
+                          'VALUES (?, ?, ?)', (comment_id, created, next_check))
+        self._commit()
+
+    def comments_due(self, limit):
+        """Select comments whose score check is due, oldest check first
+
+        :param limit: maximum amount of comments
+        :type limit: int
+        :returns: dicts with id, created and checks
+        :rtype: list[dict]
+        """
+        self._sql.execute('SELECT id, created, checks FROM comments WHERE next_check<=? '
+                          'ORDER BY next_check LIMIT ?', (time.time(), limit))
+        return [{'id': row[0], 'created': row[1], 'checks': row[2]}
+                for row in self._sql.fetchall()]
+
+    def comments_reschedule(self, schedule):
+        """Count a check and set the time of the next check for multiple comments
+
+        :param schedule: (comment id, next check) tuples
+        :type schedule: list[tuple[str, float]]
+        """
+        self._sql.executemany('UPDATE comments SET checks=checks+1, next_check=? WHERE id=?',
+                              [(next_check, comment_id) for comment_id, next_check in schedule])
+        self._commit()
+
+    def comments_delete(self, comment_ids):
+        """Stop checking comments
+
+        :param comment_ids: the comment ids
+        :type comment_ids: list[str]
+        """
+        self._execute_chunked('DELETE FROM comments WHERE id IN ({})', list(comment_ids))
+        self._commit()
+
+    def comments_forget(self, created_before):
+        """Stop checking comments created before a time
+
+        :param created_before: the cutoff time
+        :type created_before: float
+        :returns: amount of deleted comments
+        :rtype: int
+        """
+        self._sql.execute('DELETE FROM comments WHERE created<?', (created_before,))
+        self._commit()
+        return self._sql.rowcount
+
+
+class TokenBucket:
+    """Thread safe token bucket
+
+    :param rate: tokens added per second
+    :type rate: float
+    :param capacity: maximum amount of tokens, the bucket starts full
+    :type capacity: float
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, tokens=1):
+        """Get the time until tokens are available
+
+        :param tokens: amount of tokens
+        :type tokens: float
+        :returns: delay in seconds, 0 if available now
+        :rtype: float
+        """
+        with self._lock:
+            self._refill()
+            return max(0, (tokens - self._tokens) / self.rate)
+
+    def acquire(self, tokens=1):
+        """Take tokens, wait until they are available
+
+        :param tokens: amount of tokens
+        :type tokens: float
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """Pace calls to rate limited services
+
+    Every service has a token bucket that paces calls, and tracks the remaining credits and
+    reset time reported by the service. When the remaining credits drop to the reserve, the
+    service is blocked until the reset time, so work can be held back before it fails.
+    """
+    def __init__(self):
+        self._buckets = {}
+        self._reserve = {}
+        self._blocked_until = {}
+        self._lock = threading.Lock()
+
+    def add(self, service, rate, capacity, reserve=0):
+        """Add service
+
+        :param service: the service name
+        :type service: str
+        :param rate: maximum sustained calls per second
+        :type rate: float
+        :param capacity: maximum burst of calls
+        :type capacity: float
+        :param reserve: block the service if remaining credits drop to this value
+        :type reserve: float
+        """
+        self._buckets[service] = TokenBucket(rate, capacity)
+        self._reserve[service] = reserve
+        self._blocked_until[service] = 0
+
+    def update(self, service, remaining, reset):
+        """Update remaining credits from response headers
+
+        :param service: the service name
+        :type service: str
+        :param remaining: remaining credits, None if unknown
+        :type remaining: float, str, NoneType
+        :param reset: unix timestamp of the next credit reset, None if unknown
+        :type reset: float, str, NoneType
+        """
+        if remaining is None or reset is None:
+            return
+        if float(remaining) <= self._reserve[service]:
+            logging.warning('%s rate limit almost reached, %s credits remaining until %s',
+                            service, remaining, time.ctime(float(reset)))
+            self.block(service, float(reset) - time.time())
+
+    def block(self, service, seconds):
+        """Block service, e.g. after a rate limit error
+
+        :param service: the service name
+        :type service: str
+        :param seconds: how long to block the service
+        :type seconds: float
+        """
+        with self._lock:
+            self._blocked_until[service] = max(self._blocked_until[service],
+                                               time.time() + seconds)
+
+    def blocked(self, service):
+        """Get the time until the service is not blocked anymore
+
+        :param service: the service name
+        :type service: str
+        :returns: seconds, 0 if the service is not blocked
+        :rtype: float
+        """
+        return max(0, self._blocked_until[service] - time.time())
+
+    def delay(self, service, calls=1):
+        """Get the time until calls to service are allowed, without taking them
+
+        :param service: the service name
+        :type service: str
+        :param calls: amount of calls
+        :type calls: int
+        :returns: seconds, 0 if the calls are allowed now
+        :rtype: float
+        """
+        return max(self.blocked(service), self._buckets[service].delay(calls))
+
+    def acquire(self, service):
+        """Wait until a call to service is allowed
+
+        :param service: the service name
+        :type service: str
+        """
+        blocked = self.blocked(service)
+        if blocked:
+            time.sleep(blocked)
+        self._buckets[service].acquire()
+
+
+class Pipeline:
+    """Staged worker pipeline
+
+    Every stage is handled by its own pool of worker threads, stages are connected by bounded
+    queues. Results leave the pipeline in the same order the items were submitted in.
+
+    :param stages: list of (name, function, workers) tuples, function is called with the item
+        and returns the item for the next stage, or None to drop it (the following stages are
+        skipped for dropped items)
+    :type stages: list[tuple]
+    :param queue_size: maximum amount of items waiting in front of each stage
+    :type queue_size: int
+    """
+    _stop = object()
+
+    def __init__(self, stages, queue_size=16):
+        self.queue_size = queue_size
+        self._queues = [queue.Queue(queue_size) for _ in stages]
+        self._results = queue.Queue()
+        self._workers = []
+        self._submitted = 0
+        self._next = 0
+        self._done = {}
+        for index, (name, function, workers) in enumerate(stages):
+            for number in range(workers):
+                thread = threading.Thread(target=self._work, args=(index, function),
+                                          name='{}-{}'.format(name, number), daemon=True)
+                thread.start()
+                self._workers.append((index, thread))
+
+    def _work(self, index, function):
+        """Worker loop, take items from the stage queue and pass them on to the next stage
+
+        :param index: the stage index
+        :type index: int
+        :param function: the stage function
+        :type function: callable
+        """
+        in_queue = self._queues[index]
+        out_queue = self._queues[index + 1] if index + 1 < len(self._queues) else self._results
+        while True:
+            task = in_queue.get()
+            if task is self._stop:
+                return
+            sequence, item, completed = task
+            if completed:
+                try:
+                    completed = function(item) is not None
+                except Exception:
+                    logging.exception('Unhandled exception in %s, dropping item',
+                                      threading.current_thread().name)
+                    completed = False
+            # dropped items are passed on to keep the output order intact
+            out_queue.put((sequence, item, completed))
+
+    def submit(self, item):
+        """Add item to the first stage, blocks while the first queue is full
+
+        :param item: the item to process
+        """
+        self._queues[0].put((self._submitted, item, True))
+        self._submitted += 1
+
+    @property
+    def pending(self):
+        """Amount of submitted items that weren't returned by results yet"""
+        return self._submitted - self._next
+
+    def results(self, block=False):
+        """Yield finished items in submission order
+
+        :param block: if True, wait until every submitted item is finished
+        :type block: bool
+        :returns: generator of (item, completed) tuples, completed is False for dropped items
+        """
+        while self._next < self._submitted:
+            if self._next not in self._done:
+                try:
+                    sequence, item, completed = self._results.get(block=block)
+                except queue.Empty:
+                    return
+                self._done[sequence] = item, completed
+                continue
+            result = self._done.pop(self._next)
+            self._next += 1
+            yield result
+
+    def close(self):
+        """Stop all workers, every submitted item has to be finished first"""
+        for index, _ in self._workers:
+            self._queues[index].put(self._stop)
+        for _, thread in self._workers:
+            thread.join()
+
+
+class SubmissionJob:
+    """State of a queued submission passing through the pipeline
+
+    :param row: the job as returned by Database.jobs_claim
+    :type row: dict
+    """
+    bg_color = '#fff'
+    text_color = '#000'
+
+    def __init__(self, row):
+        self.job_id = row['id']
+        self.submission_id = row['submission_id']
+        self.comment_id = row['comment_id']
+        payload = json.loads(row['payload'])
+        self.url = payload['url']
+        self.title = payload['title']
+        self.boot = payload['boot']
+        self.imgur_config = payload['imgur_config']
+        self.source = None
+        self.image = None
+        self.encoded = None
+        self.render_key = None
+        self.imgur_url = None
+        self.upscaled = False
+        self.rate_limited = False
+        self.postpone = 0
+        # set by stages that drop the job because of an error that may go away on a retry
+        self.retry_error = None
+
+    @staticmethod
+    def payload(submission, title, boot):
+        """Build the job payload, everything needed to process the job without fetching the
+        submission again
+
+        :param submission: the reddit submission object
+        :type submission: praw.models.Submission
+        :param title: the title to add to the image
         :type title: str
         :param boot: if True, split title on [',', ';', '.'], else wrap text
         :type boot: bool
+        :returns: json encoded payload
+        :rtype: str
         """
-        # remove resolution appended to title (e.g. '<title> [1000 x 1000]')
-        title = RedditImage.regex_resolution.sub('', title)
-        line_height = self._font_title.getsize(title)[1] + RedditImage.margin
-        lines = self._split_title(title) if boot else self._wrap_title(title)
-        whitespace_height = (line_height * len(lines)) + RedditImage.margin
-        new = Image.new('RGB', (self._width, self._height + whitespace_height), bg_color)
-        new.paste(self._image, (0, whitespace_height))
-        draw = ImageDraw.Draw(new)
-        for i, line in enumerate(lines):
-            draw.text((RedditImage.margin, i * line_height + RedditImage.margin),
-                      line, text_color, self._font_title)
-        self._width, self._height = new.size
-        self._image = new
+        url = submission.url
+        # imgur .gifv links are video pages, the .gif of the same id is the animation
+        if urlparse(url).netloc.endswith('imgur.com') and url.endswith('.gifv'):
+            url = url[:-1]
+        return json.dumps({
+            'url': url,
+            'title': title,
+            'boot': boot,
+            'imgur_config': {
+                'album': None,
+                'name': submission.id,
+                'title': '"{}" by /u/{}'.format(submission.title, submission.author.name),
+                'description': submission.shortlink
+            }
+        })
 
-    def upload(self, imgur, config):
-        """Upload self._image to imgur
+    @property
+    def key(self):
+        """Identify the reply target, used to make the reply stage idempotent"""
+        return self.submission_id, self.comment_id
 
-        :param imgur: the imgur api client
-        :type imgur: imgurpython.client.ImgurClient
-        :param config: imgur image config
-        :type config: dict
-        :returns: imgur url if upload successful, else None
-        :rtype: str, NoneType
-        """
-        path_png = 'temp.png'
-        path_jpg = 'temp.jpg'
-        self._image.save(path_png)
-        self._image.save(path_jpg)
-        try:
-            response = imgur.upload_from_path(path_png, config, anon=False)
-        except ImgurClientError as error:
-            logging.warning('png upload failed, trying jpg | %s', error)
-            try:
-                response = imgur.upload_from_path(path_jpg, config, anon=False)
-            except ImgurClientError as error:
-                logging.error('jpg upload failed, returning | %s', error)
-                return None
-        finally:
-            remove(path_png)
-            remove(path_jpg)
-        return response['link']
 
+class CommentSweep:
+    """Remove comments of the bot that were voted down
 
-class Database:
-    """Database class
+    Replies are recorded when they are made and their score is checked on a decaying schedule:
+    first_check seconds after the reply, then with doubling intervals. Comments older than
+    max_age are not checked anymore. Scores of due comments are fetched by fullname in batches.
 
-    :param db_filename: database filename
-    :type db_filename: str
+    :param db: the database
+    :type db: Database
+    :param reddit: the reddit instance
+    :type reddit: praw.Reddit
     """
-    def __init__(self, db_filename):
-        self._sql_conn = sqlite3.connect(db_filename)
-        self._sql = self._sql_conn.cursor()
+    first_check = 5 * 60
+    max_age = 2 * 24 * 3600
+    # comments at or below this score are removed
+    score_threshold = -1
+    # maximum amount of fullnames per /api/info request
+    batch_size = 100
 
-    def message_exists(self, message_id):
-        """Check if message exists in messages table
+    def __init__(self, db, reddit):
+        self._db = db
+        self._reddit = reddit
 
-        :param message_id: the message id to check
-        :type message_id: str
-        :returns: True if message was found, else False
-        :rtype: bool
+    def record(self, comment_id, created=None):
+        """Schedule the score checks of a new comment
+
+        :param comment_id: the comment id
+        :type comment_id: str
+        :param created: the creation time, defaults to now
+        :type created: float, NoneType
         """
-        self._sql.execute('SELECT EXISTS(SELECT 1 FROM messages WHERE id=? LIMIT 1)', (message_id,))
-        if self._sql.fetchone()[0]:
-            return True
-        return False
+        created = created or time.time()
+        self._db.comment_insert(comment_id, created, created + self.first_check)
 
-    def message_insert(self, message_id, author, subject, body):
-        """Insert message into messages table"""
-        self._sql.execute('INSERT INTO messages (id, author, subject, body) VALUES (?, ?, ?, ?)',
-                          (message_id, author, subject, body))
-        self._sql_conn.commit()
+    def seed(self, limit=100):
+        """Record the latest comments of the bot once, e.g. replies made before the sweep
 
-    def submission_select(self, submission_id):
-        """Select all attributes of submission
+        :param limit: amount of comments to record
+        :type limit: int
+        """
+        if self._db.state_get('comment_sweep_seeded'):
+            return
+        cutoff = time.time() - self.max_age
+        with self._db.transaction():
+            for comment in self._reddit.user.me().comments.new(limit=limit):
+                if comment.created_utc >= cutoff:
+                    self.record(comment.id, comment.created_utc)
+            self._db.state_set('comment_sweep_seeded', '1')
 
-        :param submission_id: the submission id
-        :type submission_id: str
-        :returns: query result, None if id not found
-        :rtype: dict, NoneType
+    def sweep(self, limit=500):
+        """Check the scores of due comments, remove bad comments
+
+        :param limit: maximum amount of comments to check
+        :type limit: int
+        :returns: amount of removed comments
+        :rtype: int
         """
-        self._sql.execute('SELECT * FROM submissions WHERE id=?', (submission_id,))
-        result = self._sql.fetchone()
-        if not result:
-            return None
-        return {
-            'id': result[0],
-            'author': result[1],
-            'title': result[2],
-            'url': result[3],
-            'imgur_url': result[4],
-            'retry': result[5],
-            'timestamp': result[6]
-        }
+        now = time.time()
+        self._db.comments_forget(now - self.max_age)
+        due = self._db.comments_due(limit)
+        removed = 0
+        for i in range(0, len(due), self.batch_size):
+            batch = due[i:i + self.batch_size]
+            logging.debug('Checking scores of %s comments...', len(batch))
+            comments = {comment.id: comment for comment in
+                        self._reddit.info(fullnames=['t1_' + row['id'] for row in batch])}
+            done = []
+            schedule = []
+            for row in batch:
+                comment = comments.get(row['id'])
+                if comment is None or comment.author is None:
+                    # deleted by a moderator or manually
+                    done.append(row['id'])
+                elif comment.score <= self.score_threshold:
+                    logging.info('Removing bad comment id:%s score:%s', comment.id, comment.score)
+                    comment.delete()
+                    done.append(row['id'])
+                    removed += 1
+                else:
+                    schedule.append((row['id'], now + self.first_check * 2 ** (row['checks'] + 1)))
+            with self._db.transaction():
+                self._db.comments_delete(done)
+                self._db.comments_reschedule(schedule)
+            metrics.increment('comments_checked', len(batch))
+        return removed
 
-    def submission_insert(self, submission_id, author, title, url):
-        """Insert submission into submissions table"""
-        self._sql.execute('INSERT INTO submissions (id, author, title, url) VALUES (?, ?, ?, ?)',
-                          (submission_id, author, title, url))
-        self._sql_conn.commit()
 
-    def submission_set_retry(self, submission_id, delete_message=False, message=None):
-        """Set retry flag for given submission, delete message from db if desired
+class PeriodicTask:
+    """Task run by Scheduler at an interval that adapts to activity
 
-        :param submission_id: the submission id to set retry
-        :type submission_id: str
-        :param delete_message: if True, delete message from messages table
-        :type delete_message: bool
-        :param message: the message to delete
-        :type message: praw.models.Comment, NoneType
-        """
-        self._sql.execute('UPDATE submissions SET retry=1 WHERE id=?', (submission_id,))
-        if delete_message:
-            if not message:
-                raise TypeError('If delete_message is True, message must be set')
-            self._sql.execute('DELETE FROM messages WHERE id=?', (message.id,))
-        self._sql_conn.commit()
+    The function returns the amount of new items it found. The interval shrinks when the task
+    finds items and grows while it is idle, within min_interval and max_interval.
+
+    :param name: the task name, also used for the task_<name> timer metric
+    :type name: str
+    :param function: callable without arguments, returns the amount of new items
+    :type function: callable
+    :param min_interval: minimum seconds between runs, also the initial interval
+    :type min_interval: float
+    :param max_interval: maximum seconds between runs
+    :type max_interval: float
+    :param triggers: names of tasks to run right away after this task found items
+    :type triggers: tuple[str]
+    """
+    shrink = 0.5
+    grow = 1.5
 
-    def submission_clear_retry(self, submission_id):
-        """Clear retry flag for given submission_id
+    def __init__(self, name, function, min_interval, max_interval, triggers=()):
+        self.name = name
+        self.function = function
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.triggers = triggers
+        self.interval = min_interval
+        # run all tasks once at start
+        self.next_run = 0
 
-        :param submission_id: the submission id to clear retry
-        :type submission_id: str
+    def adapt(self, activity):
+        """Adapt the interval to the result of a run
+
+        :param activity: amount of new items found by the run
+        :type activity: int, NoneType
         """
-        self._sql.execute('UPDATE submissions SET retry=0 WHERE id=?', (submission_id,))
-        self._sql_conn.commit()
+        factor = self.shrink if activity else self.grow
+        self.interval = min(self.max_interval, max(self.min_interval, self.interval * factor))
 
-    def submission_set_imgur_url(self, submission_id, imgur_url):
-        """Set imgur url for given submission
 
-        :param submission_id: the submission id to set imgur url
-        :type submission_id: str
-        :param imgur_url: the imgur url to update
-        :type imgur_url: str
+class Scheduler:
+    """Run periodic tasks one at a time in the calling thread, the task due first runs next
+
+    :param tasks: the tasks
+    :type tasks: list[PeriodicTask]
+    :param errors: exception types that are logged instead of raised, the run counts as idle
+    :type errors: tuple[type]
+    :param hooks: context manager factories entered around every task run (e.g. CycleProfiler)
+    :type hooks: list, NoneType
+    """
+    def __init__(self, tasks, errors=(), hooks=None):
+        self._tasks = OrderedDict((task.name, task) for task in tasks)
+        self._errors = errors
+        self._hooks = hooks or []
+
+    def run_once(self):
+        """Wait until the next task is due and run it
+
+        :returns: the task that ran
+        :rtype: PeriodicTask
         """
-        self._sql.execute('UPDATE submissions SET imgur_url=? WHERE id=?',
-                          (imgur_url, submission_id))
-        self._sql_conn.commit()
+        task = min(self._tasks.values(), key=lambda candidate: candidate.next_run)
+        delay = task.next_run - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            with ExitStack() as stack:
+                for hook in self._hooks:
+                    stack.enter_context(hook())
+                stack.enter_context(metrics.timer('task_' + task.name))
+                activity = task.function()
+        except self._errors as error:
+            logging.error('Task %s failed, running it again later | %s', task.name, error)
+            activity = 0
+        task.adapt(activity)
+        now = time.monotonic()
+        task.next_run = now + task.interval
+        if activity:
+            for name in task.triggers:
+                self._tasks[name].next_run = now
+        logging.debug('Task %s found %s items, next run in %.0f seconds', task.name, activity,
+                      task.interval)
+        return task
+
+    def run_forever(self):
+        """Run tasks until interrupted"""
+        while True:
+            self.run_once()
 
 
 class TitleToImageBot:
@@ -266,12 +2563,84 @@ class TitleToImageBot:
 
     :param subreddit: the subreddit(s) to process, can be concatenated with +
     :type subreddit: str
+    :param workers: amount of worker threads per pipeline stage (download, render, encode,
+        upload)
+    :type workers: dict, NoneType
+    :param queue_size: maximum amount of submissions waiting in front of each stage
+    :type queue_size: int
+    :param max_download_size: maximum size of a downloaded image in bytes
+    :type max_download_size: int
+    :param max_image_size: maximum width and height of the source image, larger images are
+        scaled down
+    :type max_image_size: int
+    :param cache_dir: directory of the image cache
+    :type cache_dir: str
+    :param cache_size: maximum size of the image cache in bytes
+    :type cache_size: int
+    :param incremental: if True, only fetch new inbox items, run also fetches the hot listing
+        only every full_sync_every cycles (tasks polls it at its own interval)
+    :type incremental: bool
+    :param full_sync_every: in incremental mode, do a full fetch every n cycles or inbox polls
+    :type full_sync_every: int
+    :param cycle_summary: if True, log a summary of stage timings and events after each cycle
+    :type cycle_summary: bool
+    :param shard: (index, count) of this worker, workers on the same host share the job queue
+        in database.db, the first worker also removes bad comments
+    :type shard: tuple[int, int]
+    :param lease_time: seconds until a job or message claimed by this worker can be claimed by
+        another worker
+    :type lease_time: float
     """
-    def __init__(self, subreddit):
-        self._db = Database('database.db')
+    default_workers = {'download': 4, 'render': 2, 'encode': 2, 'upload': 2}
+    # mentions are processed before submissions from the hot listing
+    priority_mention = 10
+    priority_submission = 0
+    # (rate per second, burst capacity, reserved credits) per service, shared by all shards,
+    # an upload costs 10 imgur credits, uploads are also limited to 1250 per day
+    rate_limits = {
+        'imgur': (1250 / 86400, 50, 10),
+        'reddit': (0.5, 5, 5)
+    }
+    # (minimum, maximum) seconds between runs of the scheduled tasks, see tasks
+    task_intervals = {
+        'inbox': (10, 120),
+        'jobs': (5, 60),
+        'maintenance': (300, 300)
+    }
+    # jobs that would wait longer than this many seconds for an upload or reply are postponed
+    # before they are downloaded and rendered
+    max_pacing_wait = 10
+    # finished jobs are deleted after this many seconds
+    job_max_age = 7 * 24 * 60 * 60
+    # seconds to wait after a reddit ratelimit error without a reset time
+    ratelimit_delay = 60
+    regex_ratelimit = re.compile(r'(\d+) (minute|second)')
+    regex_custom_title = re.compile(r'.*u/titletoimagebot\s*["“”](.+)["“”].*',
+                                    re.IGNORECASE)
+
+    def __init__(self, subreddit, workers=None, queue_size=16,
+                 max_download_size=20 * 1024 * 1024, max_image_size=RedditImage.max_size,
+                 cache_dir='cache', cache_size=1024 * 1024 * 1024, incremental=False,
+                 full_sync_every=10, cycle_summary=False, shard=(0, 1), lease_time=600):
+        # imported here, RedditImage can be used without api credentials (e.g. benchmark.py)
+        import apidata
+        self._shard = shard
+        # stable across restarts, a restarted worker releases its own leases immediately
+        owner = '{}/{}'.format(socket.gethostname(), shard[0])
+        self._db = Database('database.db', owner, lease_time)
         self._reddit = praw.Reddit(**apidata.reddit)
-        self._subreddit = self._reddit.subreddit(subreddit)
-        self._imgur = ImgurClient(**apidata.imgur)
+        # a shard can have no subreddits, it only processes the inbox and jobs then
+        self._subreddit = self._reddit.subreddit(subreddit) if subreddit else None
+        self._imgur = ImgurUploader(ImgurClient(**apidata.imgur))
+        self._downloader = ImageDownloader(max_bytes=max_download_size)
+        self._max_image_size = max_image_size
+        self._cache = ImageCache(cache_dir, cache_size)
+        self._incremental = incremental
+        self._full_sync_every = full_sync_every
+        self._cycle = 0
+        self._cycle_summary = cycle_summary
+        # context manager factories entered around every cycle, e.g. CycleProfiler
+        self.cycle_hooks = []
         self._template = (
             '[Image with added title]({image_url})\n\n'
             '{upscaled}---\n\n'
@@ -280,18 +2649,44 @@ class TitleToImageBot:
             '?to=TitleToImageBot&subject=feedback%20{submission_id}) | '
             '[source](https://github.com/gerenook/titletoimagebot)'
         )
+        workers = dict(self.default_workers, **(workers or {}))
+        self._pipeline = Pipeline([
+            ('download', self._download_stage, workers['download']),
+            ('render', self._render_stage, workers['render']),
+            ('encode', self._encode_stage, workers['encode']),
+            ('upload', self._upload_stage, workers['upload'])
+        ], queue_size)
+        self._replied = set()
+        self._name = None
+        # inbox items to mark as read in one request, see _flush_read_markers
+        self._read_markers = []
+        # submissions of mentions fetched in bulk by _prefetch_submissions
+        self._mention_submissions = {}
+        self._sweep = CommentSweep(self._db, self._reddit)
+        self._limiter = RateLimiter()
+        # the buckets are per process, every shard gets its part of the rate
+        for service, (rate, capacity, reserve) in self.rate_limits.items():
+            self._limiter.add(service, rate / shard[1], max(1, capacity / shard[1]), reserve)
+        released = self._db.jobs_release()
+        if released:
+            logging.info('Resuming %s interrupted jobs', released)
 
     def _reply_imgur_url(self, url, submission, source_comment, upscaled=False):
-        """doc todo
+        """Reply with the imgur url
 
-        :param url: -
+        :param url: the imgur url
         :type url: str
-        :param submission: -
-        :type submission: -
-        :param source_comment: -
-        :type source_comment: -
-        :returns: True on success, False on failure
-        :rtype: bool
+        :param submission: the submission, reply at top level if source_comment is None
+        :type submission: praw.models.Submission
+        :param source_comment: the comment to reply to
+        :type source_comment: praw.models.Comment, NoneType
+        :param upscaled: if True, mention that the image was upscaled
+        :type upscaled: bool
+        :returns: the reply on success, None on failure
+        :rtype: praw.models.Comment, NoneType
+        :raises praw.exceptions.APIException: on reddit api errors (e.g. ratelimit)
+        :raises prawcore.exceptions.RequestException: on network errors
+        :raises prawcore.exceptions.ServerError: on reddit server errors
         """
         logging.debug('Creating reply')
         reply = self._template.format(
@@ -301,21 +2696,19 @@ class TitleToImageBot:
         )
         try:
             if source_comment:
-                source_comment.reply(reply)
-            else:
-                submission.reply(reply)
-        except praw.exceptions.APIException as error:
-            logging.error('Reddit api error, setting retry flag in database | %s', error)
-            self._db.submission_set_retry(submission.id, bool(source_comment), source_comment)
-            return False
+                return source_comment.reply(reply)
+            return submission.reply(reply)
+        except (praw.exceptions.APIException, RequestException, ServerError):
+            raise
         except Exception as error:
             logging.error('Cannot reply, skipping submission | %s', error)
-            return False
-        self._db.submission_clear_retry(submission.id)
-        return True
+            return None
 
     def _process_submission(self, submission, source_comment=None, custom_title=None):
-        """Generate new image with added title and author, upload to imgur, reply to submission
+        """Check submission and add it to the job queue
+
+        Queued jobs are processed by _process_jobs: the new image with added title is generated
+        and uploaded to imgur in the pipeline (download, render, upload), _finish_job replies.
 
         :param submission: the reddit submission object
         :type submission: praw.models.Submission
@@ -324,10 +2717,13 @@ class TitleToImageBot:
         :type source_comment: praw.models.Comment, NoneType
         :param custom_title: if not None, use as title instead of submission title
         :type custom_title: str
+        :returns: True if a new job was queued
+        :rtype: bool
         """
         # TODO really need to clean this method up
         # return if author account is deleted
         if not submission.author:
+            metrics.increment('skipped')
             return
         sub = submission.subreddit.display_name
         # in r/fakehistoryporn, only process upvoted submissions
@@ -336,6 +2732,7 @@ class TitleToImageBot:
             if submission.score < score_threshold:
                 logging.debug('Score below %d in subreddit %s, skipping submission',
                               score_threshold, sub)
+                metrics.increment('skipped')
                 return
         # check db if submission was already processed
         author = submission.author.name
@@ -343,7 +2740,7 @@ class TitleToImageBot:
         url = submission.url
         result = self._db.submission_select(submission.id)
         if result:
-            if result['retry'] or source_comment:
+            if source_comment:
                 if result['imgur_url']:
                     # logging.info('Submission id:%s found in database with imgur url set, ' +
                     #              'trying to create reply', submission.id)
@@ -370,48 +2767,297 @@ class TitleToImageBot:
             triggers = [',', ';', 'roses']
             if not any(t in title.lower() for t in triggers):
                 logging.info('Title is probably not part of rhyme, skipping submission')
+                metrics.increment('skipped')
                 return
-        if url.endswith('.gif') or url.endswith('.gifv'):
-            logging.info('Image is animated gif, skipping submission')
-            return
-        logging.debug('Trying to download image from %s', url)
-        try:
-            response = requests.get(url)
-            img = Image.open(BytesIO(response.content))
-        except OSError as error:
-            logging.warning('Converting to image failed, trying with <url>.jpg | %s', error)
+        payload = SubmissionJob.payload(submission, custom_title or title, boot)
+        if source_comment:
+            queued = self._db.job_enqueue(source_comment.id, submission.id, source_comment.id,
+                                          payload, self.priority_mention)
+        else:
+            queued = self._db.job_enqueue(submission.id, submission.id, None, payload,
+                                          self.priority_submission)
+        metrics.increment('queued')
+        return queued
+
+    def _download_stage(self, job):
+        """Pipeline stage: download the source image
+
+        :param job: the submission job
+        :type job: SubmissionJob
+        :returns: the job, None to skip the submission
+        :rtype: SubmissionJob, NoneType
+        """
+        content_hash = self._cache.source_hash(job.url)
+        data = None
+        if content_hash:
+            job.render_key = self._cache.render_key(content_hash, job.title, job.boot,
+                                                    job.bg_color, job.text_color)
+            record = self._cache.get_render(job.render_key)
+            if record:
+                logging.info('Found rendered image in cache, skipping download and upload')
+                metrics.increment('cache_hit_render')
+                job.imgur_url = record['imgur_url']
+                job.upscaled = record['upscaled']
+                return job
+            # the source is only read if the render has to be done again
+            data = self._cache.get_source(content_hash)
+            if data is not None:
+                metrics.increment('cache_hit_source')
+        if data is None:
+            logging.debug('Trying to download image from %s', job.url)
             try:
-                response = requests.get(url + '.jpg')
-                img = Image.open(BytesIO(response.content))
+                with metrics.timer('download'):
+                    data = self._downloader.download(job.url)
             except OSError as error:
-                logging.error('Converting to image failed, skipping submission | %s', error)
-                return
-        image = RedditImage(img)
+                logging.error('Downloading image failed, skipping submission | %s', error)
+                metrics.increment('error_download')
+                if isinstance(error, DownloadError) and error.transient:
+                    job.retry_error = str(error)
+                return None
+            content_hash = self._cache.put_source(job.url, data)
+            job.render_key = self._cache.render_key(content_hash, job.title, job.boot,
+                                                    job.bg_color, job.text_color)
+        with metrics.timer('open'):
+            job.source = Image.open(BytesIO(data))
+        return job
+
+    def _render_stage(self, job):
+        """Pipeline stage: add the title to the source image
+
+        :param job: the submission job
+        :type job: SubmissionJob
+        :returns: the job, None to skip the submission
+        :rtype: SubmissionJob, NoneType
+        """
+        if job.imgur_url:
+            return job
+        try:
+            with metrics.timer('init'):
+                job.image = RedditImage.create(job.source, self._max_image_size)
+        except OSError as error:
+            logging.error('Decoding image failed, skipping submission | %s', error)
+            metrics.increment('error_decode')
+            return None
+        finally:
+            job.source = None
+        job.upscaled = job.image.upscaled
         logging.debug('Adding title')
-        if custom_title:
-            image.add_title(custom_title, boot)
-        else:
-            image.add_title(title, boot)
+        with metrics.timer('add_title'):
+            job.image.add_title(job.title, job.boot, job.bg_color, job.text_color)
+        return job
+
+    def _encode_stage(self, job):
+        """Pipeline stage: encode the new image in the output format for the source
+
+        :param job: the submission job
+        :type job: SubmissionJob
+        :returns: the job, None to skip the submission
+        :rtype: SubmissionJob, NoneType
+        """
+        if job.imgur_url:
+            return job
+        try:
+            job.encoded = job.image.encode()
+        except OSError as error:
+            logging.error('Encoding image failed, skipping submission | %s', error)
+            metrics.increment('error_encode')
+            return None
+        logging.debug('Encoded %s bytes as %s', len(job.encoded[0]), job.encoded[1])
+        return job
+
+    def _upload_stage(self, job):
+        """Pipeline stage: upload the new image to imgur
+
+        :param job: the submission job
+        :type job: SubmissionJob
+        :returns: the job, None to skip the submission
+        :rtype: SubmissionJob, NoneType
+        """
+        if job.imgur_url:
+            return job
+        job.postpone = self._limiter.blocked('imgur')
+        if job.postpone:
+            return job
         logging.debug('Trying to upload new image')
-        imgur_config = {
-            'album': None,
-            'name': submission.id,
-            'title': '"{}" by /u/{}'.format(title, author),
-            'description': submission.shortlink
-        }
+        self._limiter.acquire('imgur')
         try:
-            imgur_url = image.upload(self._imgur, imgur_config)
+            job.imgur_url = job.image.upload(self._imgur, job.imgur_config, job.encoded)
         except ImgurClientRateLimitError as rate_error:
-            logging.error('Imgur ratelimit error, setting retry flag in database | %s', rate_error)
-            self._db.submission_set_retry(submission.id, bool(source_comment), source_comment)
+            logging.error('Imgur ratelimit error, retrying job later | %s', rate_error)
+            credits = self._imgur.credits
+            reset = float(credits['UserReset']) - time.time() if credits.get('UserReset') else 0
+            self._limiter.block('imgur', max(reset, self.ratelimit_delay))
+            metrics.increment('ratelimit_imgur')
+            job.rate_limited = True
+            return job
+        except requests.RequestException as error:
+            logging.error('Cannot upload new image, retrying job later | %s', error)
+            metrics.increment('error_upload')
+            job.retry_error = str(error)
+            return None
+        finally:
+            self._update_imgur_credits()
+        if not job.imgur_url:
+            # imgur api errors are mostly server errors, retries are limited by job_retry
+            logging.error('Cannot upload new image, retrying job later')
+            metrics.increment('error_upload')
+            job.retry_error = 'upload failed'
+            return None
+        job.image = None
+        job.encoded = None
+        self._cache.put_render(job.render_key, job.imgur_url, job.upscaled)
+        return job
+
+    def _finish_job(self, job):
+        """Last stage, runs in the main thread: update database and reply
+
+        Jobs are finished in the order they were submitted in, a reply target is only ever
+        replied to once. No transaction is open during the reply, the result is written
+        afterwards and only if the job is still leased to this worker.
+
+        :param job: the submission job
+        :type job: SubmissionJob
+        """
+        if job.rate_limited:
+            self._db.job_retry(job.job_id, 'imgur ratelimit')
+            metrics.increment('retry')
+            return
+        if not job.postpone:
+            job.postpone = self._limiter.blocked('reddit')
+        if job.postpone:
+            logging.info('Rate limit reached, postponing job %s by %.0f seconds',
+                         job.job_id, job.postpone)
+            self._db.job_postpone(job.job_id, job.postpone)
+            metrics.increment('postponed')
+            return
+        if job.key in self._replied:
+            logging.debug('Already replied to submission id:%s, skipping', job.submission_id)
+            self._db.job_done(job.job_id)
             return
-        if not imgur_url:
-            logging.error('Cannot upload new image, skipping submission')
+        self._db.submission_set_imgur_url(job.submission_id, job.imgur_url)
+        submission = self._reddit.submission(id=job.submission_id)
+        source_comment = self._reddit.comment(id=job.comment_id) if job.comment_id else None
+        self._limiter.acquire('reddit')
+        try:
+            with metrics.timer('reply'):
+                replied = self._reply_imgur_url(job.imgur_url, submission, source_comment,
+                                                upscaled=job.upscaled)
+        except praw.exceptions.APIException as error:
+            logging.error('Reddit api error, retrying job later | %s', error)
+            self._limiter.block('reddit', self._ratelimit_seconds(str(error)))
+            self._db.job_retry(job.job_id, str(error))
+            metrics.increment('retry')
             return
-        self._db.submission_set_imgur_url(submission.id, imgur_url)
-        if not self._reply_imgur_url(imgur_url, submission, source_comment, upscaled=image.upscaled):
+        except (RequestException, ServerError) as error:
+            logging.error('Cannot reply, retrying job later | %s', error)
+            self._db.job_retry(job.job_id, str(error))
+            metrics.increment('retry')
+            return
+        finally:
+            limits = self._reddit.auth.limits
+            self._limiter.update('reddit', limits.get('remaining'), limits.get('reset_timestamp'))
+        if not replied:
+            self._db.job_done(job.job_id, 'failed', 'reply failed')
+            metrics.increment('error_reply')
             return
-        logging.info('Successfully processed submission')
+        with self._db.transaction():
+            if not self._db.job_done(job.job_id):
+                logging.warning('Lease of job %s expired while replying', job.job_id)
+                metrics.increment('lease_lost')
+            self._sweep.record(replied.id)
+        metrics.increment('processed')
+        self._replied.add(job.key)
+        logging.info('Successfully processed submission id:%s', job.submission_id)
+
+    def _update_imgur_credits(self):
+        """Update the rate limiter with the imgur credits of the last response"""
+        credits = self._imgur.credits
+        remaining = [float(credits[key]) for key in ('UserRemaining', 'ClientRemaining')
+                     if credits.get(key) is not None]
+        if remaining:
+            self._limiter.update('imgur', min(remaining), credits.get('UserReset'))
+
+    def _ratelimit_seconds(self, message):
+        """Get the wait time from a reddit ratelimit message
+
+        :param message: the error message (e.g. 'try again in 9 minutes')
+        :type message: str
+        :returns: seconds to wait, ratelimit_delay if the message contains no time
+        :rtype: float
+        """
+        match = self.regex_ratelimit.search(message)
+        if not match:
+            return self.ratelimit_delay
+        amount, unit = match.groups()
+        return int(amount) * (60 if unit == 'minute' else 1)
+
+    def _finish_jobs(self, block=False):
+        """Finish all jobs that passed the pipeline
+
+        :param block: if True, wait for every submitted job
+        :type block: bool
+        """
+        for job, completed in self._pipeline.results(block):
+            # the renewed lease is committed right away, no other worker takes the job over
+            # while it is finished, and the write lock isn't held during reddit requests
+            if not self._db.job_renew(job.job_id):
+                logging.warning('Lease of job %s expired, leaving it to its new owner',
+                                job.job_id)
+                metrics.increment('lease_lost')
+            elif completed:
+                self._finish_job(job)
+            elif job.retry_error:
+                self._db.job_retry(job.job_id, job.retry_error)
+                metrics.increment('retry')
+            else:
+                self._db.job_done(job.job_id, 'failed', 'skipped in pipeline')
+
+    def _process_jobs(self, batch_size, max_jobs=None, block=True):
+        """Run due jobs from the job queue through the pipeline
+
+        :param batch_size: amount of jobs to claim at once
+        :type batch_size: int
+        :param max_jobs: stop after claiming this many jobs, None to run all due jobs
+        :type max_jobs: int, NoneType
+        :param block: if True, wait until the claimed jobs are finished, else only claim as many
+            jobs as fit into the pipeline and finish the jobs that already passed it, the rest
+            is finished by later calls
+        :type block: bool
+        :returns: amount of claimed jobs
+        :rtype: int
+        """
+        claimed = 0
+        while max_jobs is None or claimed < max_jobs:
+            limit = batch_size if max_jobs is None else min(batch_size, max_jobs - claimed)
+            if not block:
+                # submit never waits for room in the first queue
+                limit = min(limit, self._pipeline.queue_size - self._pipeline.pending)
+                if limit <= 0:
+                    break
+            jobs = self._db.jobs_claim(limit)
+            if not jobs:
+                break
+            claimed += len(jobs)
+            logging.debug('Processing %s jobs...', len(jobs))
+            for row in jobs:
+                # hold jobs back before download and render instead of waiting for an upload
+                # or reply slot with the rendered image in memory, every job in the pipeline
+                # will take one call of each service
+                calls = self._pipeline.pending + 1
+                wait = max(self._limiter.delay('imgur', calls),
+                           self._limiter.delay('reddit', calls))
+                if wait > self.max_pacing_wait:
+                    logging.info('Rate limit reached, postponing job %s by %.0f seconds',
+                                 row['id'], wait)
+                    self._db.job_postpone(row['id'], wait)
+                    metrics.increment('postponed')
+                    continue
+                self._pipeline.submit(SubmissionJob(row))
+                self._finish_jobs()
+            if block:
+                self._finish_jobs(block=True)
+        self._finish_jobs()
+        return claimed
 
     def _process_feedback_message(self, message):
         """Forward message to creator
@@ -426,90 +3072,335 @@ class TitleToImageBot:
         self._reddit.redditor(__author__).message(subject, body)
         logging.info('Forwarded message to author')
 
+    @property
+    def _bot_name(self):
+        """The name of the bot account, fetched once"""
+        if self._name is None:
+            self._name = self._reddit.user.me().name
+        return self._name
+
+    @staticmethod
+    def _is_mention(message):
+        """Check if message is a comment that summons the bot
+
+        :param message: the inbox item
+        :type message: praw.models.Message, praw.models.Comment
+        :rtype: bool
+        """
+        if not isinstance(message, praw.models.Comment):
+            return False
+        subject = message.subject.lower()
+        return (subject == 'username mention' or
+                (subject == 'comment reply' and 'u/titletoimagebot' in message.body.lower()))
+
+    def _prefetch_submissions(self, messages):
+        """Fetch the submissions of all mentions in messages with one request
+
+        :param messages: inbox items
+        :type messages: list
+        """
+        fullnames = {message.submission.fullname for message in messages
+                     if message.author and self._is_mention(message)}
+        if not fullnames:
+            return
+        logging.debug('Fetching %s submissions of mentions...', len(fullnames))
+        submissions = self._reddit.info(fullnames=list(fullnames))
+        self._mention_submissions = {submission.id: submission for submission in submissions}
+
+    def _mark_read(self, message):
+        """Mark message as read with the next _flush_read_markers call"""
+        self._read_markers.append(message)
+
+    def _flush_read_markers(self):
+        """Mark all collected inbox items as read, praw sends 25 items per request"""
+        if self._read_markers:
+            logging.debug('Marking %s inbox items as read', len(self._read_markers))
+            self._reddit.inbox.mark_read(self._read_markers)
+            self._read_markers = []
+
     def _process_message(self, message):
         """Process given message (remove, feedback, mark good/bad bot as read)
 
+        Read markers are collected, see _flush_read_markers. Requests to reddit are made before
+        anything is written, the message and its job are written in one short transaction at
+        the end, so other workers don't wait for the write lock during requests.
+
         :param message: the inbox message, comment reply or username mention
         :type message: praw.models.Message, praw.models.Comment
         """
         if not message.author:
             return
         # check db if message was already processed
-        author = message.author.name
-        subject = message.subject.lower()
-        body_original = message.body
-        body = message.body.lower()
         if self._db.message_exists(message.id):
             logging.debug('Message %s found in database, returning', message.id)
             return
+        author = message.author.name
+        subject = message.subject.lower()
+        body = message.body.lower()
         logging.debug('Message: %s | %s', subject, body)
-        logging.debug('Adding message to database')
-        self._db.message_insert(message.id, author, subject, body)
         # check if message was sent, instead of received
-        if author == self._reddit.user.me().name:
+        if author == self._bot_name:
             logging.debug('Message was sent, returning')
-            return
         # process message
-        if (isinstance(message, praw.models.Comment) and
-                (subject == 'username mention' or
-                 (subject == 'comment reply' and 'u/titletoimagebot' in body))):
+        elif self._is_mention(message):
             # You win this time, AutoModerator
-            if message.author.name.lower() == 'automoderator':
-                message.mark_read()
+            if author.lower() == 'automoderator':
+                self._mark_read(message)
+            else:
+                match = self.regex_custom_title.match(message.body)
+                title = None
+                if match:
+                    title = match.group(1)
+                    if len(title) > 512:
+                        title = None
+                    else:
+                        logging.debug('Found custom title: %s', title)
+                submission = self._mention_submissions.pop(message.submission.id,
+                                                           message.submission)
+                # loads a submission that wasn't prefetched, before the transaction
+                logging.debug('Mention of submission %s: %s', submission.id, submission.title)
+                with self._db.transaction():
+                    logging.debug('Adding message to database')
+                    self._db.message_insert(message.id, author, subject, body)
+                    self._process_submission(submission, message, title)
+                self._mark_read(message)
                 return
-            match = re.match(r'.*u/titletoimagebot\s*["“”](.+)["“”].*',
-                             body_original, re.RegexFlag.IGNORECASE)
-            title = None
-            if match:
-                title = match.group(1)
-                if len(title) > 512:
-                    title = None
-                else:
-                    logging.debug('Found custom title: %s', title)
-            self._process_submission(message.submission, message, title)
-            message.mark_read()
         elif subject.startswith('feedback'):
             self._process_feedback_message(message)
         # mark short good/bad bot comments as read to keep inbox clean
         elif 'good bot' in body and len(body) < 12:
             logging.debug('Good bot message or comment reply found, marking as read')
-            message.mark_read()
+            self._mark_read(message)
         elif 'bad bot' in body and len(body) < 12:
             logging.debug('Bad bot message or comment reply found, marking as read')
-            message.mark_read()
+            self._mark_read(message)
+        logging.debug('Adding message to database')
+        self._db.message_insert(message.id, author, subject, body)
+
+    def _poll_submissions(self, limit, full_sync):
+        """Process the hot listing
+
+        :param limit: amount of submissions to process
+        :type limit: int
+        :param full_sync: False to skip the hot listing in incremental mode
+        :type full_sync: bool
+        :returns: amount of queued submissions
+        :rtype: int
+        """
+        if not self._subreddit or (self._incremental and not full_sync):
+            return 0
+        logging.debug('Processing last %s submissions...', limit)
+        queued = 0
+        for page in _pages(self._subreddit.hot(limit=limit)):
+            # jobs have unique keys, workers seeing the same submission don't queue it twice
+            with self._db.transaction():
+                self._db.submissions_select_many(submission.id for submission in page)
+                for submission in page:
+                    queued += bool(self._process_submission(submission))
+        return queued
+
+    def _process_page(self, page):
+        """Process a page of inbox items, skip items leased to other workers
+
+        Every message is committed on its own, after its requests to reddit, see
+        _process_message.
+
+        :param page: the inbox items
+        :type page: list
+        :returns: amount of processed new items
+        :rtype: int
+        """
+        known = self._db.messages_existing(message.id for message in page)
+        new = [message for message in page if message.id not in known]
+        claimed = self._db.leases_acquire(['message:' + message.id for message in new])
+        for message in new:
+            if 'message:' + message.id not in claimed:
+                logging.debug('Message %s is leased to another worker', message.id)
+        new = [message for message in new if 'message:' + message.id in claimed]
+        self._prefetch_submissions(new)
+        for message in new:
+            self._process_message(message)
+        self._mention_submissions = {}
+        return len(new)
+
+    def _poll_inbox(self, limit, full_sync):
+        """Process the inbox
+
+        In incremental mode, only items newer than the stored cursor are fetched. A full sync
+        fetches the latest items and stops paginating at the first page without new items.
+        Every shard has its own cursor, a message leased to a shard that crashed is still newer
+        than the cursor of that shard when it restarts.
+
+        :param limit: amount of messages to process
+        :type limit: int
+        :param full_sync: True to ignore the cursor
+        :type full_sync: bool
+        :returns: amount of processed new items
+        :rtype: int
+        """
+        processed = 0
+        if not self._incremental:
+            logging.debug('Processing last %s messages...', limit)
+            for page in _pages(self._reddit.inbox.all(limit=limit)):
+                processed += self._process_page(page)
+            return processed
+        cursor_key = 'inbox_cursor:{}'.format(self._shard[0])
+        cursor = self._db.state_get(cursor_key)
+        if cursor and not full_sync:
+            logging.debug('Processing messages newer than %s...', cursor)
+            listing = self._reddit.inbox.all(limit=min(limit, 100), params={'before': cursor})
+        else:
+            logging.debug('Processing last %s messages until known messages...', limit)
+            listing = self._reddit.inbox.all(limit=limit)
+        newest = None
+        for page in _pages(listing):
+            newest = newest or page[0].fullname
+            page_processed = self._process_page(page)
+            processed += page_processed
+            # stop at the first page without new items (or only items of other workers)
+            if not page_processed:
+                break
+        if newest:
+            self._db.state_set(cursor_key, newest)
+        return processed
 
     def run(self, limit):
         """Run the bot
 
-        Process submissions and messages, remove bad comments
+        Queue submissions and messages, process the job queue, remove bad comments
 
         :param limit: amount of submissions/messages to process
         :type limit: int
         """
-        logging.debug('Processing last %s submissions...', limit)
-        for submission in self._subreddit.hot(limit=limit):
-            self._process_submission(submission)
-        logging.debug('Processing last %s messages...', limit)
-        for message in self._reddit.inbox.all(limit=limit):
-            self._process_message(message)
+        with ExitStack() as stack:
+            for hook in self.cycle_hooks:
+                stack.enter_context(hook())
+            stack.enter_context(metrics.timer('cycle'))
+            self._run(limit)
+        if self._cycle_summary:
+            logging.info('Cycle summary: %s', metrics.summary())
+
+    def _run(self, limit):
+        """Run one cycle, see run
+
+        :param limit: amount of submissions/messages to process
+        :type limit: int
+        """
+        self._replied.clear()
+        full_sync = self._cycle % self._full_sync_every == 0
+        self._cycle += 1
+        self._poll_submissions(limit, full_sync)
+        self._poll_inbox(limit, full_sync)
+        self._flush_read_markers()
+        self._process_jobs(limit)
+        if self._shard[0] == 0:
+            self._maintenance()
+
+    def _maintenance(self):
+        """Expire leases, prune finished jobs and remove bad comments, only run by the first
+        shard
+
+        :returns: amount of removed comments
+        :rtype: int
+        """
+        self._db.leases_expire()
+        pruned = self._db.jobs_prune(time.time() - self.job_max_age)
+        if pruned:
+            logging.info('Pruned %s finished jobs', pruned)
         logging.debug('Removing bad comments...')
-        for comment in self._reddit.user.me().comments.new(limit=100):
-            if comment.score <= -1:
-                logging.info('Removing bad comment id:%s score:%s', comment.id, comment.score)
-                comment.delete()
+        self._sweep.seed()
+        return self._sweep.sweep()
+
+    def _inbox_task(self, limit):
+        """Scheduled task: poll the inbox, see tasks"""
+        full_sync = self._cycle % self._full_sync_every == 0
+        self._cycle += 1
+        processed = self._poll_inbox(limit, full_sync)
+        self._flush_read_markers()
+        return processed
+
+    def _jobs_task(self, limit):
+        """Scheduled task: start at most limit due jobs and finish started jobs, see tasks
+
+        Doesn't wait for the pipeline, so other tasks run while images are downloaded,
+        rendered and uploaded. Jobs in the pipeline count as activity, the task runs again soon
+        to finish them.
+        """
+        if not self._pipeline.pending:
+            # reply targets of jobs in the pipeline are still checked against earlier replies
+            self._replied.clear()
+        claimed = self._process_jobs(limit, limit, block=False)
+        return claimed + self._pipeline.pending
+
+    def _summary_task(self):
+        """Scheduled task: log the summary of stage timings and events"""
+        logging.info('Summary: %s', metrics.summary())
+        return 0
+
+    def tasks(self, limit, interval):
+        """Create the periodic tasks for Scheduler, an alternative to calling run in a loop
+
+        Mentions are latency sensitive, the inbox is polled more often than the hot listing
+        and new items run the jobs task right away. Jobs are started in batches of at most limit
+        jobs, mentions are claimed first, and finished by the following runs of the jobs task.
+        In incremental mode, the inbox does a full sync every full_sync_every polls, the hot
+        listing is always fetched.
+
+        :param limit: amount of submissions/messages to fetch per poll and jobs per batch
+        :type limit: int
+        :param interval: minimum seconds between polls of the hot listing, idle polls back off
+            up to four times as much
+        :type interval: float
+        :returns: the tasks
+        :rtype: list[PeriodicTask]
+        """
+        tasks = [
+            PeriodicTask('inbox', lambda: self._inbox_task(limit),
+                         *self.task_intervals['inbox'], triggers=('jobs',)),
+            PeriodicTask('submissions', lambda: self._poll_submissions(limit, True),
+                         interval, interval * 4, triggers=('jobs',)),
+            PeriodicTask('jobs', lambda: self._jobs_task(limit), *self.task_intervals['jobs'])
+        ]
+        if self._shard[0] == 0:
+            tasks.append(PeriodicTask('maintenance', self._maintenance,
+                                      *self.task_intervals['maintenance']))
+        if self._cycle_summary:
+            tasks.append(PeriodicTask('summary', self._summary_task,
+                                      *self.task_intervals['maintenance']))
+        return tasks
+
 
+def _pages(listing, size=100):
+    """Group listing items into pages, praw fetches listings in pages of 100
 
-def _setup_logging(level):
+    :param listing: the listing generator
+    :type listing: iterable
+    :param size: the page size
+    :type size: int
+    :returns: generator of item lists
+    """
+    page = []
+    for item in listing:
+        page.append(item)
+        if len(page) == size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def _setup_logging(level, filename='./log/titletoimagebot.log'):
     """Setup the root logger
 
     logs to stdout and to daily log files in ./log/
 
     :param level: the logging level (e.g. logging.WARNING)
     :type level: int
+    :param filename: the log file, rotated at midnight
+    :type filename: str
     """
     console_handler = logging.StreamHandler()
-    file_handler = TimedRotatingFileHandler('./log/titletoimagebot.log',
-                                            when='midnight', interval=1)
+    file_handler = TimedRotatingFileHandler(filename, when='midnight', interval=1)
     file_handler.suffix = '%Y-%m-%d'
     module_loggers = ['requests', 'urllib3', 'prawcore', 'PIL.Image', 'PIL.PngImagePlugin']
     for logger in module_loggers:
@@ -529,35 +3420,271 @@ def _handle_exception(exc_type, exc_value, exc_traceback):
     logging.critical('Unhandled exception:\n', exc_info=(exc_type, exc_value, exc_traceback))
 
 
+# per process state of render-batch workers, set by _init_batch_worker
+_batch_worker = {}
+
+
+def _init_batch_worker(output_dir, font_file, max_image_size, max_download_size):
+    """Initialize a render-batch worker process"""
+    if font_file:
+        RedditImage.font_file = font_file
+    _batch_worker['output_dir'] = output_dir
+    _batch_worker['max_image_size'] = max_image_size
+    _batch_worker['downloader'] = ImageDownloader(max_bytes=max_download_size)
+
+
+def _render_batch_item(line_number, line):
+    """Render one manifest row and write the output file, runs in a worker process
+
+    :param line_number: the line number in the manifest, names the output if the row has no id
+    :type line_number: int
+    :param line: the json encoded manifest row
+    :type line: str
+    :returns: the result row
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    result = {'line': line_number}
+    try:
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise ValueError('manifest row is not an object')
+        result['id'] = str(row.get('id', line_number))
+        result['source'] = source = row['source']
+        if urlparse(source).scheme in ('http', 'https'):
+            data = _batch_worker['downloader'].download(source)
+        else:
+            with open(source, 'rb') as source_file:
+                data = source_file.read()
+        image = RedditImage.create(Image.open(BytesIO(data)), _batch_worker['max_image_size'])
+        image.add_title(row['title'], row.get('boot', False),
+                        row.get('bg_color', SubmissionJob.bg_color),
+                        row.get('text_color', SubmissionJob.text_color))
+        encoded, image_format = image.encode()
+        extension = {'JPEG': 'jpg'}.get(image_format, image_format.lower())
+        path = os.path.join(_batch_worker['output_dir'], '{}.{}'.format(
+            re.sub(r'[^\w.-]', '_', result['id']), extension))
+        # rows never overwrite each other, duplicate ids (also after replacing special
+        # characters, e.g. 'a/b' and 'a_b') fail with FileExistsError
+        with open(path, 'xb') as output_file:
+            output_file.write(encoded)
+        result.update(output=path, format=image_format, bytes=len(encoded),
+                      upscaled=image.upscaled)
+    except Exception as error:
+        # any error fails only this row, the rest of the backfill goes on
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def render_batch(argv):
+    """Render a manifest of images with a process pool, see main
+
+    The manifest is read and the results are written line by line, at most --window rows are
+    in flight, memory use doesn't depend on the size of the manifest. Results are written in
+    completion order.
+
+    :param argv: the command line arguments after 'render-batch'
+    :type argv: list[str]
+    :returns: the exit status, 1 if any row failed
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(prog='titletoimagebot.py render-batch')
+    parser.add_argument('manifest', help='jsonl manifest, - for stdin')
+    parser.add_argument('output_dir', help='directory of the rendered images')
+    parser.add_argument('--results', help='results jsonl (default OUTPUT_DIR/results.jsonl)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='amount of worker processes (default: number of cpus)')
+    parser.add_argument('--window', type=int,
+                        help='maximum amount of rows in flight (default 4 per process)')
+    parser.add_argument('--font', help='font file (default {})'.format(RedditImage.font_file))
+    parser.add_argument('--max-image-size', type=int, default=RedditImage.max_size,
+                        help='scale down images wider or higher than this (default {})'.format(
+                            RedditImage.max_size))
+    parser.add_argument('--max-download-size', type=int, default=20,
+                        help='maximum size of a downloaded image in MiB (default 20)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+    os.makedirs(args.output_dir, exist_ok=True)
+    window = args.window or args.processes * 4
+    results_path = args.results or os.path.join(args.output_dir, 'results.jsonl')
+    counts = {'done': 0, 'failed': 0}
+    start = time.time()
+    initargs = (os.path.abspath(args.output_dir), args.font and os.path.abspath(args.font),
+                args.max_image_size, args.max_download_size * 1024 * 1024)
+
+    def write_results(futures):
+        for future in futures:
+            result = future.result()
+            counts['failed' if 'error' in result else 'done'] += 1
+            results_file.write(json.dumps(result) + '\n')
+            total = counts['done'] + counts['failed']
+            if not total % 1000:
+                logging.info('%s rows, %s failed, %.1f rows/s', total, counts['failed'],
+                             total / (time.time() - start))
+
+    with ExitStack() as stack:
+        manifest = sys.stdin if args.manifest == '-' else stack.enter_context(open(args.manifest))
+        results_file = stack.enter_context(open(results_path, 'w'))
+        executor = stack.enter_context(ProcessPoolExecutor(
+            args.processes, initializer=_init_batch_worker, initargs=initargs))
+        pending = set()
+        for line_number, line in enumerate(manifest, 1):
+            if not line.strip():
+                continue
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write_results(done)
+            pending.add(executor.submit(_render_batch_item, line_number, line))
+        write_results(wait(pending).done)
+    logging.info('Rendered %s rows, %s failed in %.0f seconds, results in %s',
+                 counts['done'], counts['failed'], time.time() - start, results_path)
+    return 1 if counts['failed'] else 0
+
+
+def _shard(value):
+    """Parse the --shard argument
+
+    :param value: index/count, e.g. '0/4'
+    :type value: str
+    :returns: (index, count)
+    :rtype: tuple[int, int]
+    :raises argparse.ArgumentTypeError: if value is not a valid shard
+    """
+    match = re.fullmatch(r'(\d+)/(\d+)', value)
+    if not match or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError('expected index/count with index < count, e.g. 0/4')
+    return int(match.group(1)), int(match.group(2))
+
+
 def main():
     """Main function
 
-    Usage: ./titletoimagebot.py [-h] limit interval
+    Usage: ./titletoimagebot.py [-h] [--download-workers N] [--render-workers N]
+                                [--encode-workers N] [--upload-workers N] [--queue-size N]
+                                [--max-download-size MIB] [--max-image-size PX]
+                                [--cache-dir DIR] [--cache-size MIB] [--incremental]
+                                [--full-sync-every N] [--metrics-port PORT]
+                                [--metrics-file PATH] [--cycle-summary] [--shard I/N]
+                                [--lease-time SECONDS] [--fixed-interval] limit interval
+
+    Inbox, hot listing, job queue and maintenance run as separate tasks, their intervals adapt
+    to activity: the inbox is polled every 10 to 120 seconds, the hot listing every interval to
+    4 * interval seconds. --fixed-interval runs everything in one cycle every interval seconds.
+    --incremental only fetches new inbox items, with --fixed-interval it also skips the hot
+    listing except every --full-sync-every cycles.
+
+    Send SIGUSR1 to profile the next cycle (the next task with the scheduler) with cProfile.
+
+    To run several worker processes on the same host, start each one with a different --shard,
+    e.g. '--shard 0/4' to '--shard 3/4', in the same directory. The subreddits are split between
+    the workers, all workers process the inbox and the job queue, leases make sure every message
+    and job is processed once. database.db uses sqlite's WAL mode, which needs shared memory, so
+    the workers can't share it over a network filesystem or between hosts.
 
-    e.g. './titletoimagebot 10 60' will process the last 10 submissions/messages every 60 seconds.
+    e.g. './titletoimagebot 10 60' will process the last 10 submissions/messages, the hot listing
+    every 60 to 240 seconds.
+
+    Batch mode: ./titletoimagebot.py render-batch [-h] [--results PATH] [--processes N]
+                                                  [--window N] [--font FONT]
+                                                  [--max-image-size PX]
+                                                  [--max-download-size MIB] manifest output_dir
+
+    Renders every row of a jsonl manifest with a process pool, e.g. to re-render old
+    submissions. Rows have the keys source (path or url), title and optionally id, boot,
+    bg_color and text_color. Outputs are named after the id and never overwritten, rows whose
+    output file exists already fail. A manifest of the submissions table can be exported with
+    sqlite3 database.db "SELECT json_object('id', id, 'source', url, 'title', title)
+    FROM submissions" > manifest.jsonl
     """
-    _setup_logging(logging.INFO)
-    sys.excepthook = _handle_exception
+    if sys.argv[1:2] == ['render-batch']:
+        sys.exit(render_batch(sys.argv[2:]))
     parser = argparse.ArgumentParser()
     parser.add_argument('limit', help='amount of submissions/messages to process each cycle',
                         type=int)
-    parser.add_argument('interval', help='time (in seconds) to wait between cycles', type=int)
+    parser.add_argument('interval', type=int,
+                        help='time (in seconds) to wait between cycles, with the scheduler the '
+                             'minimum time between polls of the hot listing')
+    for stage, workers in TitleToImageBot.default_workers.items():
+        parser.add_argument('--{}-workers'.format(stage), type=int, default=workers,
+                            help='amount of {} worker threads (default {})'.format(stage, workers))
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help='maximum amount of submissions waiting in front of each stage')
+    parser.add_argument('--max-download-size', type=int, default=20,
+                        help='maximum size of a downloaded image in MiB (default 20)')
+    parser.add_argument('--max-image-size', type=int, default=RedditImage.max_size,
+                        help='scale down images wider or higher than this (default {})'.format(
+                            RedditImage.max_size))
+    parser.add_argument('--cache-dir', default='cache',
+                        help='directory of the image cache (default cache)')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='maximum size of the image cache in MiB (default 1024)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch new inbox items, with --fixed-interval also fetch the '
+                             'hot listing only every --full-sync-every cycles (the scheduler '
+                             'polls it at its own interval)')
+    parser.add_argument('--full-sync-every', type=int, default=10,
+                        help='in incremental mode, do a full fetch every n cycles or inbox '
+                             'polls (default 10)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve prometheus metrics on this local port')
+    parser.add_argument('--metrics-file',
+                        help='write prometheus metrics to this file after each cycle')
+    parser.add_argument('--cycle-summary', action='store_true',
+                        help='log stage timings and events after each cycle')
+    parser.add_argument('--fixed-interval', action='store_true',
+                        help='run everything in one cycle every interval seconds instead of '
+                             'scheduling inbox, hot listing, jobs and maintenance separately')
+    parser.add_argument('--shard', type=_shard, default=(0, 1), metavar='I/N',
+                        help='run as worker I of N on this host, workers split the '
+                             'subreddits (default 0/1)')
+    parser.add_argument('--lease-time', type=float, default=600,
+                        help='seconds until work of a crashed worker is taken over (default 600)')
     args = parser.parse_args()
+    index, count = args.shard
+    if count > 1:
+        _setup_logging(logging.INFO, './log/titletoimagebot-{}.log'.format(index))
+    else:
+        _setup_logging(logging.INFO)
+    sys.excepthook = _handle_exception
     logging.debug('Initializing bot')
     with open('subreddits.json') as subreddits_file:
-        sub = '+'.join(json.load(subreddits_file))
-    bot = TitleToImageBot(sub)
+        sub = '+'.join(json.load(subreddits_file)[index::count])
+    workers = {stage: getattr(args, '{}_workers'.format(stage))
+               for stage in TitleToImageBot.default_workers}
+    bot = TitleToImageBot(sub, workers, args.queue_size, args.max_download_size * 1024 * 1024,
+                          args.max_image_size, args.cache_dir, args.cache_size * 1024 * 1024,
+                          args.incremental, args.full_sync_every, args.cycle_summary,
+                          args.shard, args.lease_time)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if hasattr(signal, 'SIGUSR1'):
+        profiler = CycleProfiler()
+        signal.signal(signal.SIGUSR1, profiler.request)
+        bot.cycle_hooks.append(profiler)
+    errors = (requests.exceptions.ReadTimeout,
+              requests.exceptions.ConnectionError,
+              ResponseException,
+              RequestException)
+    if not args.fixed_interval:
+        logging.info('Bot initialized, processing the last %s submissions/messages, hot listing '
+                     'every %s to %s seconds', args.limit, args.interval, args.interval * 4)
+        tasks = bot.tasks(args.limit, args.interval)
+        if args.metrics_file:
+            tasks.append(PeriodicTask('metrics_file',
+                                      lambda: metrics.write_textfile(args.metrics_file), 60, 60))
+        Scheduler(tasks, errors, bot.cycle_hooks).run_forever()
     logging.info('Bot initialized, processing the last %s submissions/messages every %s seconds',
                  args.limit, args.interval)
     while True:
         try:
             logging.debug('Running bot')
             bot.run(args.limit)
+            if args.metrics_file:
+                metrics.write_textfile(args.metrics_file)
             logging.debug('Bot finished, restarting in %s seconds', args.interval)
-        except (requests.exceptions.ReadTimeout,
-                requests.exceptions.ConnectionError,
-                ResponseException,
-                RequestException):
+        except errors:
             logging.error('Reddit api timed out, restarting')
             continue
         time.sleep(args.interval)